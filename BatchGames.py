@@ -0,0 +1,223 @@
+import numpy as np
+
+from Games import TicTacToe, VierGewinnt
+
+
+class _BatchGame:
+    '''
+    N boards of the same game, played in lockstep: every call to step() applies one move to each
+    board. All boards are kept in NumPy arrays, so wins, draws and rewards of all boards are
+    computed with array operations instead of one method call per board and move.
+
+    The rules and rewards are the same as in play() of the scalar game:
+        - invalid moves get R_INVALID instantly and the same player has to move again
+        - a winning/drawing move gets R_WIN/R_DRAW instantly, the opponent gets R_DEFEAT/R_DRAW
+          for his last move
+        - any other move gets R_DEFAULT as soon as the opponent moved, together with the state
+          that the opponent's move led to
+    Finished boards are reset automatically.
+
+    States are state codes as sent by the scalar game, so Q-tables can be shared between both.
+    Experiences are returned as arrays (S, a, r, nextS) with nextS = NONE for terminal states.
+    legal() returns the legal-action masks of all boards, e.g. for Qlearner.selectActions().
+
+    Subclasses implement the rules in _place(), _won(), _draw(), _clear() and legal().
+    '''
+
+    NONE = -1
+
+    def __init__(self, N, game):
+        self.game = game
+        self.POSSIBLE_ACTIONS = game.POSSIBLE_ACTIONS
+        self.R_DEFAULT = game.R_DEFAULT
+        self._N = N
+        self._codes = np.full(N, game.EMPTY_CODE, dtype=np.int64)
+        self._whosturn = np.zeros(N, dtype=np.int64)
+        # state and action of each player's last move, waiting for the opponent's move
+        self._pendingS = np.full((2, N), self.NONE, dtype=np.int64)
+        self._pendingA = np.zeros((2, N), dtype=np.int64)
+
+    @property
+    def N(self):
+        return self._N
+
+    def states(self):
+        return self._codes.copy()
+
+    def whosturn(self):
+        return self._whosturn.copy()
+
+    def reset(self):
+        self._reset(np.arange(self._N))
+
+    def _reset(self, idx):
+        self._clear(idx)
+        self._codes[idx] = self.game.EMPTY_CODE
+        self._whosturn[idx] = 0
+        self._pendingS[:, idx] = self.NONE
+
+    def step(self, actions):
+        '''
+        Apply one move to every board.
+        :param actions: Array with one action per board, for the player whose turn it is
+        :return: Tuple (experiences, status).
+            experiences is a tuple of arrays (S, a, r, nextS) with all experiences that are complete
+            after this step.
+            status is an array with the game status of every board (game.READY if the game goes
+            on, the winner or game.DRAW if it finished and has been reset)
+        '''
+        game = self.game
+        actions = np.asarray(actions, dtype=np.int64)
+        player = self._whosturn.copy()
+        S = self._codes.copy()
+        everyboard = np.arange(self._N)
+
+        valid = self._place(actions)
+        won = np.zeros(self._N, dtype=bool)
+        won[valid] = self._won(everyboard[valid])
+        draw = valid & ~won & self._draw()
+        goeson = valid & ~won & ~draw
+
+        # collect all experiences (S, a, r, nextS) that are complete after this move
+        parts = []
+        invalid = everyboard[~valid]
+        parts.append((S[invalid], actions[invalid], np.full(len(invalid), game.R_INVALID),
+                      np.full(len(invalid), self.NONE)))
+        for mask, rmover, ropponent in ((won, game.R_WIN, game.R_DEFEAT),
+                                        (draw, game.R_DRAW, game.R_DRAW)):
+            idx = everyboard[mask]
+            parts.append((S[idx], actions[idx], np.full(len(idx), rmover),
+                          np.full(len(idx), self.NONE)))
+            parts.append(self._pendingExperiences(idx, 1 - player[idx], ropponent, terminal=True))
+        idx = everyboard[goeson]
+        parts.append(self._pendingExperiences(idx, 1 - player[idx], game.R_DEFAULT, terminal=False))
+        experiences = tuple(np.concatenate([part[k] for part in parts]) for k in range(4))
+
+        # the mover's move waits for its reward, then it's the opponent's turn
+        self._pendingS[player[idx], idx] = S[idx]
+        self._pendingA[player[idx], idx] = actions[idx]
+        self._whosturn[idx] = 1 - player[idx]
+
+        status = np.full(self._N, game.READY, dtype=np.int64)
+        status[won] = player[won]
+        status[draw] = game.DRAW
+        self._reset(everyboard[won | draw])
+
+        return experiences, status
+
+    def _pendingExperiences(self, idx, player, r, terminal):
+        has = self._pendingS[player, idx] != self.NONE
+        idx = idx[has]
+        player = player[has]
+        nextS = np.full(len(idx), self.NONE) if terminal else self._codes[idx]
+        return (self._pendingS[player, idx], self._pendingA[player, idx], np.full(len(idx), r),
+                nextS)
+
+
+class TicTacToeBatch(_BatchGame):
+    '''
+    N TicTacToe boards played in lockstep, see _BatchGame.
+    '''
+
+    def __init__(self, N):
+        _BatchGame.__init__(self, N, TicTacToe())
+        self._boards = np.full((N, 9), TicTacToe.UNMARKED, dtype=np.int8)
+        self._lines = np.array(self.game.winners)
+        self._pow3 = np.array(TicTacToe._POW3, dtype=np.int64)
+
+    def _clear(self, idx):
+        self._boards[idx] = TicTacToe.UNMARKED
+
+    def legal(self):
+        # one row per board, one column per field
+        return self._boards == TicTacToe.UNMARKED
+
+    def _place(self, actions):
+        valid = (actions >= 1) & (actions <= 9)
+        idx = np.flatnonzero(valid)
+        field = actions[idx] - 1
+        free = self._boards[idx, field] == TicTacToe.UNMARKED
+        idx = idx[free]
+        field = field[free]
+        valid[:] = False
+        valid[idx] = True
+        player = self._whosturn[idx]
+        self._boards[idx, field] = player
+        self._codes[idx] += (player - TicTacToe.UNMARKED) * self._pow3[field]
+        return valid
+
+    def _won(self, idx):
+        player = self._whosturn[idx]
+        lines = self._boards[idx][:, self._lines]
+        return (lines == player[:, None, None]).all(axis=2).any(axis=1)
+
+    def _draw(self):
+        # draw if the board is full
+        return (self._boards != TicTacToe.UNMARKED).all(axis=1)
+
+
+class VierGewinntBatch(_BatchGame):
+    '''
+    N VierGewinnt boards played in lockstep, see _BatchGame.
+    Boards are kept as bitboards, one int64 per board and player, so the board size is limited
+    to ncols * (nrows + 1) <= 63 bits, e.g. 7 x 6, like the state codes (see VierGewinnt.MAXBITS).
+    '''
+
+    def __init__(self, N, nrows=VierGewinnt.NROWS, ncols=VierGewinnt.NCOLS,
+                 connect=VierGewinnt.CONNECT):
+        _BatchGame.__init__(self, N, VierGewinnt(nrows, ncols, connect))
+        self._nrows = nrows
+        self._ncols = ncols
+        self._connect = connect
+        self._heights = np.zeros((N, self._ncols), dtype=np.int64)
+        self._bitboards = np.zeros((2, N), dtype=np.int64)
+        self._shifts = self.game._bbshifts
+        # one bitmask per winning line, see VierGewinnt._winninglines
+        h1 = nrows + 1
+        self._linemasks = np.array([sum(1 << ((field % ncols) * h1 + field // ncols)
+                                        for field in line)
+                                    for line in self.game._winninglines], dtype=np.int64)
+
+    def _clear(self, idx):
+        self._heights[idx] = 0
+        self._bitboards[:, idx] = 0
+
+    def legal(self):
+        # one row per board, one column per column of the board
+        return self._heights < self._nrows
+
+    def _place(self, actions):
+        valid = (actions >= 1) & (actions <= self._ncols)
+        idx = np.flatnonzero(valid)
+        col = actions[idx] - 1
+        row = self._heights[idx, col]
+        free = row < self._nrows
+        idx = idx[free]
+        col = col[free]
+        row = row[free]
+        valid[:] = False
+        valid[idx] = True
+        player = self._whosturn[idx]
+        bit = np.left_shift(1, col * (self._nrows + 1) + row)
+        self._bitboards[player, idx] |= bit
+        self._codes[idx] += (1 + player) * bit
+        self._heights[idx, col] += 1
+        return valid
+
+    def _won(self, idx):
+        bb = self._bitboards[self._whosturn[idx], idx]
+        won = np.zeros(len(idx), dtype=bool)
+        for shift in self._shifts:
+            m = bb
+            for k in range(1, self._connect):
+                m = m & (m >> shift)
+            won |= m != 0
+        return won
+
+    def _draw(self):
+        # draw if no line is open any more, i.e. every line has stones of both players, like
+        # VierGewinnt.checkdraw()
+        lines = self._linemasks[None, :]
+        open0 = ((self._bitboards[1][:, None] & lines) == 0).any(axis=1)
+        open1 = ((self._bitboards[0][:, None] & lines) == 0).any(axis=1)
+        return ~(open0 | open1)
@@ -0,0 +1,232 @@
+'''
+Evaluation of a trained Q-table: its greedy policy plays against an opponent, in both seat
+orders, on a process pool.
+
+    python Evaluation.py models/QVierGewinnt.pkl [--game VierGewinnt] [--opponent DumbAI]
+        [--games 1000] [--workers 4]
+
+Only the game, player and learner modules are needed, so this also runs on headless training
+hosts without matplotlib or curses.
+'''
+import time
+import math
+import random
+import argparse
+import multiprocessing
+import numpy as np
+
+from Games import TicTacToe, VierGewinnt
+from Learners import Qlearner, PairQStore, RowQStore, DenseQStore, MappedQStore
+from Players import DumbAI, SmartAI
+from Search import SearchAI, MCTSAI
+
+OUTCOMES = ('wins', 'draws', 'losses')
+
+# storage formats of Qfiles, see loadQlearner()
+STORES = ('RowQStore', 'PairQStore', 'DenseQStore', 'MappedQStore')
+
+
+class GreedyAI(SmartAI):
+    '''
+    SmartAI that plays the greedy policy of its Qlearner (curiosity None) and does not learn.
+    A small curiosity makes it play a near-greedy Boltzmann policy instead, e.g. so that two
+    greedy policies don't play the same game over and over.
+    '''
+
+    def __init__(self, somename, ql, curiosity=None):
+        SmartAI.__init__(self, somename, None, ql, curiosity=curiosity)
+
+    def sendReward(self, reward, resultingState):
+        DumbAI.sendReward(self, reward, resultingState)
+
+    def finalize(self):
+        DumbAI.finalize(self)
+
+
+def wilson(k, n, z=1.96):
+    '''
+    Wilson score interval of a binomial proportion.
+    :param k: Number of successes
+    :param n: Number of trials
+    :param z: Quantile of the normal distribution, 1.96 for a 95% interval
+    :return: Tuple (low, high)
+    '''
+    if n == 0:
+        return 0.0, 1.0
+    p = k / n
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    halfwidth = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, center - halfwidth), min(1.0, center + halfwidth)
+
+
+def loadQlearner(board, Qfile, store='RowQStore', symmetry=True):
+    '''
+    :param store: Storage format of Qfile, one of STORES. DenseQStore is for TicTacToe only.
+    :param symmetry: True if the Q-table was learned with the game as symmetry, i.e. with
+        Qlearner(..., symmetry=board)
+    '''
+    possibleActions = board.POSSIBLE_ACTIONS
+    defaultReward = board.R_DEFAULT
+    symmetry = board if symmetry else None
+    if store == 'RowQStore':
+        qstore = RowQStore(possibleActions, defaultReward, encodeState=board.encodeState,
+                           symmetry=symmetry)
+    elif store == 'PairQStore':
+        qstore = PairQStore(possibleActions, defaultReward)
+    elif store == 'DenseQStore':
+        if not isinstance(board, TicTacToe):
+            raise ValueError('DenseQStore is only available for TicTacToe')
+        qstore = DenseQStore(TicTacToe.enumerateStates(), possibleActions, defaultReward)
+    elif store == 'MappedQStore':
+        qstore = MappedQStore(possibleActions, defaultReward)
+    else:
+        raise ValueError('Unknown store {}'.format(store))
+    return Qlearner(Qfile, possibleActions, defaultReward, alpha=0.1, lam=0.8, store=qstore,
+                    symmetry=symmetry)
+
+
+def makeOpponent(board, opponent, opponentArgs, seed):
+    '''
+    :param opponent: 'DumbAI', 'SearchAI', 'MCTSAI' or 'GreedyAI' (another Q-table, the Qfile is
+        given in opponentArgs, optionally with its store and symmetry, see loadQlearner())
+    :param opponentArgs: Dict of keyword arguments for the player, e.g. {'budget': 100}
+    '''
+    opponentArgs = dict(opponentArgs or {})
+    if opponent == 'DumbAI':
+        return DumbAI('Dumbo', None, board.POSSIBLE_ACTIONS)
+    elif opponent == 'SearchAI':
+        return SearchAI('Search AI', board, **opponentArgs)
+    elif opponent == 'MCTSAI':
+        opponentArgs.setdefault('seed', seed)
+        return MCTSAI('MCTS AI', board, **opponentArgs)
+    elif opponent == 'GreedyAI':
+        return GreedyAI('Greedy AI', loadQlearner(board, opponentArgs['Qfile'],
+                                                  opponentArgs.get('store', 'RowQStore'),
+                                                  opponentArgs.get('symmetry', True)))
+    raise ValueError('Unknown opponent {}'.format(opponent))
+
+
+# per worker process: the board and the Qlearner, loaded once by _initWorker()
+_worker = {}
+
+
+def _initWorker(board, Qfile, store, symmetry):
+    _worker['board'] = board
+    _worker['ql'] = loadQlearner(board, Qfile, store, symmetry)
+
+
+def _play(task):
+    '''
+    Worker: play n games of the greedy policy against the opponent.
+    :param task: Tuple (seat of the greedy player, n, opponent, opponentArgs, seed)
+    :return: Tuple (seat, array with the number of wins, draws and losses of the greedy player)
+    '''
+    seat, n, opponent, opponentArgs, seed = task
+    random.seed(seed)
+    np.random.seed(seed)
+    board = _worker['board']
+    ql = _worker['ql']
+    ql.seed(seed)
+    players = [makeOpponent(board, opponent, opponentArgs, seed)]
+    players.insert(seat, GreedyAI('Greedy AI', ql))
+    board.setplayers(players)
+    counts = np.zeros(3, dtype=np.int64)
+    for i in range(0, n):
+        board.reset()
+        board.play()
+        if board._status == seat:
+            counts[0] += 1
+        elif board._status == board.DRAW:
+            counts[1] += 1
+        else:
+            counts[2] += 1
+    return seat, counts
+
+
+def evaluate(board, Qfile, opponent='DumbAI', opponentArgs=None, N=1000, nworkers=None, seed=0,
+             chunksize=100, store='RowQStore', symmetry=True):
+    '''
+    Play N games in each seat order. Games are distributed over the workers in chunks; every
+    worker loads the Q-table once.
+    :param board: Game instance, e.g. VierGewinnt()
+    :param Qfile: Q-table to evaluate, as saved by Qlearner.saveQ()
+    :param store, symmetry: How the Q-table was learned, see loadQlearner()
+    :param opponent, opponentArgs: See makeOpponent()
+    :param nworkers: Number of worker processes, defaults to the number of CPUs
+    :param seed: Every chunk is seeded deterministically from (seed, seat, chunk number)
+    :return: Dict with the counts, rates and 95% confidence intervals of wins, draws and losses
+        of the greedy player as first player, as second player and in total, and games/sec
+    '''
+    tasks = []
+    for seat in (0, 1):
+        for idx, start in enumerate(range(0, N, chunksize)):
+            chunkseed = int(np.random.SeedSequence([seed, seat, idx]).generate_state(1)[0])
+            tasks.append((seat, min(chunksize, N - start), opponent, opponentArgs, chunkseed))
+
+    counts = {0: np.zeros(3, dtype=np.int64), 1: np.zeros(3, dtype=np.int64)}
+    t0 = time.perf_counter()
+    with multiprocessing.Pool(nworkers, initializer=_initWorker,
+                              initargs=(board, Qfile, store, symmetry)) as pool:
+        for seat, c in pool.imap_unordered(_play, tasks):
+            counts[seat] += c
+    sec = time.perf_counter() - t0
+
+    result = {'game': type(board).__name__, 'opponent': opponent, 'games': 2 * N,
+              'games/sec': 2 * N / sec}
+    for name, c in (('first', counts[0]), ('second', counts[1]), ('total', counts[0] + counts[1])):
+        n = int(c.sum())
+        result[name] = {}
+        for outcome, k in zip(OUTCOMES, c.tolist()):
+            result[name][outcome] = {'count': k, 'rate': k / n if n else 0.0,
+                                     'ci95': wilson(k, n)}
+    return result
+
+
+def report(result):
+    lines = ['{} games of {}: greedy Q vs {}, {:.1f} games/sec'.format(
+        result['games'], result['game'], result['opponent'], result['games/sec'])]
+    lines.append('  {:8s}'.format('seat') + ''.join('{:>24s}'.format(o) for o in OUTCOMES))
+    for name in ('first', 'second', 'total'):
+        line = '  {:8s}'.format(name)
+        for outcome in OUTCOMES:
+            r = result[name][outcome]
+            line += '   {:.3f} [{:.3f}, {:.3f}]'.format(r['rate'], r['ci95'][0], r['ci95'][1])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate the greedy policy of a Q-table.')
+    parser.add_argument('Qfile')
+    parser.add_argument('--game', choices=['TicTacToe', 'VierGewinnt'], default='VierGewinnt')
+    parser.add_argument('--nrows', type=int, default=VierGewinnt.NROWS)
+    parser.add_argument('--ncols', type=int, default=VierGewinnt.NCOLS)
+    parser.add_argument('--connect', type=int, default=VierGewinnt.CONNECT)
+    parser.add_argument('--opponent', choices=['DumbAI', 'SearchAI', 'MCTSAI', 'GreedyAI'],
+                        default='DumbAI')
+    parser.add_argument('--budget', type=float,
+                        help='time budget per move of SearchAI (sec) or MCTSAI (ms)')
+    parser.add_argument('--opponentQfile', help='Q-table of the GreedyAI opponent')
+    parser.add_argument('--store', choices=STORES, default='RowQStore',
+                        help='storage format of the Q-tables')
+    parser.add_argument('--nosymmetry', action='store_true',
+                        help='the Q-tables were learned without symmetry')
+    parser.add_argument('--games', type=int, default=1000, help='games per seat order')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.game == 'TicTacToe':
+        board = TicTacToe()
+    else:
+        board = VierGewinnt(args.nrows, args.ncols, args.connect)
+    opponentArgs = {}
+    if args.budget is not None:
+        opponentArgs['budget'] = args.budget
+    if args.opponentQfile is not None:
+        opponentArgs.update(Qfile=args.opponentQfile, store=args.store,
+                            symmetry=not args.nosymmetry)
+    print(report(evaluate(board, args.Qfile, args.opponent, opponentArgs, args.games,
+                          args.workers, args.seed, store=args.store,
+                          symmetry=not args.nosymmetry)))
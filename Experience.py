@@ -0,0 +1,163 @@
+import os
+import numpy as np
+
+# Experience logs are binary files: a header followed by fixed-width records, one per experience
+# (S, a, r, nextS) as sent by the game to a player. Terminal states (None) are stored as NONE.
+# The last experience of each game is marked with last = 1.
+MAGIC = b'RGEXPLOG'
+VERSION = 1
+NONE = -1
+EXPERIENCE_DTYPE = np.dtype([('S', '<i8'),
+                             ('a', '<i2'),
+                             ('r', '<f4'),
+                             ('nextS', '<i8'),
+                             ('last', 'u1')])
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('recordsize', '<u4')])
+
+
+def game2records(game):
+    '''
+    :param game: List of experiences (S, a, r, nextS), e.g. DumbAI._game
+    :return: Record array with EXPERIENCE_DTYPE
+    '''
+    records = np.zeros(len(game), dtype=EXPERIENCE_DTYPE)
+    for idx, (S, a, r, nextS) in enumerate(game):
+        records[idx] = (S, a, r, NONE if nextS is None else nextS, 0)
+    if len(game) > 0:
+        records['last'][-1] = 1
+    return records
+
+
+def records2game(records):
+    '''
+    Inverse of game2records().
+    :return: List of experiences (S, a, r, nextS)
+    '''
+    return [(S, a, r, None if nextS == NONE else nextS)
+            for S, a, r, nextS in zip(records['S'].tolist(), records['a'].tolist(),
+                                      records['r'].tolist(), records['nextS'].tolist())]
+
+
+def appendGame(experienceFile, game):
+    '''
+    Append the experiences of one game to an experience log, create it if necessary.
+    '''
+    if len(game) == 0:
+        return
+    with open(experienceFile, 'ab') as f:
+        if f.tell() == 0:
+            header = np.array([(MAGIC, VERSION, EXPERIENCE_DTYPE.itemsize)], dtype=HEADER_DTYPE)
+            f.write(header.tobytes())
+        f.write(game2records(game).tobytes())
+
+
+class ExperienceLog:
+    '''
+    Read access to an experience log file.
+    The file is memory-mapped, i.e. only the parts that are read are loaded into RAM, and games
+    are streamed one at a time. Iterating over an ExperienceLog yields the games as lists of
+    experiences, so it can directly be passed to Qlearner.batchlearnQ().
+    '''
+
+    # number of records that are scanned at once for game boundaries
+    CHUNKSIZE = 1 << 20
+
+    def __init__(self, experienceFile):
+        header = np.fromfile(experienceFile, dtype=HEADER_DTYPE, count=1)
+        if len(header) == 0 or header['magic'][0] != MAGIC or header['version'][0] != VERSION \
+                or header['recordsize'][0] != EXPERIENCE_DTYPE.itemsize:
+            raise ValueError('{} is not an experience log'.format(experienceFile))
+        nbytes = os.path.getsize(experienceFile) - HEADER_DTYPE.itemsize
+        if nbytes >= EXPERIENCE_DTYPE.itemsize:
+            self._records = np.memmap(experienceFile, dtype=EXPERIENCE_DTYPE, mode='r',
+                                      offset=HEADER_DTYPE.itemsize,
+                                      shape=(nbytes // EXPERIENCE_DTYPE.itemsize,))
+        else:
+            self._records = np.zeros(0, dtype=EXPERIENCE_DTYPE)
+
+    def __len__(self):
+        # number of experiences, not games
+        return len(self._records)
+
+    @property
+    def records(self):
+        return self._records
+
+    def iterRecords(self):
+        '''
+        Stream the games as record arrays (views into the memory map).
+        '''
+        start = 0
+        for chunkstart in range(0, len(self._records), self.CHUNKSIZE):
+            chunk = self._records['last'][chunkstart:chunkstart + self.CHUNKSIZE]
+            for end in (np.flatnonzero(chunk) + chunkstart + 1).tolist():
+                yield self._records[start:end]
+                start = end
+
+    def __iter__(self):
+        for records in self.iterRecords():
+            yield records2game(records)
+
+
+class ReplayBuffer:
+    '''
+    Fixed-capacity ring buffer of experiences (S, a, r, nextS) in preallocated NumPy arrays.
+    When the buffer is full, new experiences overwrite the oldest ones.
+    Minibatches are sampled uniformly or, for prioritized replay, with probability proportional
+    to priority ** alpha, where the priority is the magnitude of the last TD error (new
+    experiences get the highest priority seen so far, so they are replayed at least once).
+    '''
+
+    def __init__(self, capacity, alpha=0.6, seed=None):
+        '''
+        :param alpha: Exponent of the priorities, 0 is uniform sampling
+        :param seed: Seed for the sampling; drawn from NumPy's global random state if None
+        '''
+        self._capacity = capacity
+        self._alpha = alpha
+        self._S = np.zeros(capacity, dtype=np.int64)
+        self._a = np.zeros(capacity, dtype=np.int64)
+        self._r = np.zeros(capacity, dtype=np.float64)
+        self._nextS = np.zeros(capacity, dtype=np.int64)
+        self._priorities = np.zeros(capacity, dtype=np.float64)
+        self._maxpriority = 1.0
+        self._next = 0
+        self._size = 0
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, S, a, r, nextS):
+        idx = self._next
+        self._S[idx] = S
+        self._a[idx] = a
+        self._r[idx] = r
+        self._nextS[idx] = NONE if nextS is None else nextS
+        self._priorities[idx] = self._maxpriority
+        self._next = (idx + 1) % self._capacity
+        self._size = min(self._size + 1, self._capacity)
+
+    def addGame(self, game):
+        for S, a, r, nextS in game:
+            self.add(S, a, r, nextS)
+
+    def sample(self, batchsize, prioritized=False):
+        '''
+        :return: Tuple (indices, S, a, r, nextS) of arrays; nextS is NONE for terminal states
+        '''
+        if prioritized:
+            P = self._priorities[:self._size] ** self._alpha
+            cumP = np.cumsum(P)
+            u = self._rng.random(batchsize) * cumP[-1]
+            idx = np.minimum(np.searchsorted(cumP, u, side='right'), self._size - 1)
+        else:
+            idx = self._rng.integers(0, self._size, batchsize)
+        return idx, self._S[idx], self._a[idx], self._r[idx], self._nextS[idx]
+
+    def updatePriorities(self, idx, tderrors, eps=1e-3):
+        priorities = np.abs(tderrors) + eps
+        self._priorities[idx] = priorities
+        self._maxpriority = max(self._maxpriority, float(priorities.max()))
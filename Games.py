@@ -1,4 +1,50 @@
 
+def _d4permutations():
+    '''
+    The 8 rotations/reflections of the 3x3 TicTacToe board as field permutations.
+    perm[idx] is the field that field idx is moved to; field idx = 3 * row + col.
+    '''
+    perms = []
+    for reflect in (False, True):
+        for nrot in range(0, 4):
+            perm = []
+            for idx in range(0, 9):
+                row, col = divmod(idx, 3)
+                if reflect:
+                    col = 2 - col
+                for i in range(0, nrot):
+                    row, col = col, 2 - row
+                perm.append(3 * row + col)
+            perms.append(tuple(perm))
+    return tuple(perms)
+
+
+def _winninglines(nrows, ncols, connect):
+    '''
+    All lines of "connect" fields on a nrows x ncols VierGewinnt board.
+    Field (idxrow, idxcol) has the number idxrow * ncols + idxcol.
+    :return: Tuple (lines, celllines): lines[idxline] is the tuple of fields of a line,
+        celllines[field] is the tuple of the numbers of all lines through that field
+    '''
+    lines = []
+    for drow, dcol in ((0, 1),    # horizontal
+                       (1, 0),    # vertical
+                       (1, 1),    # diagonal: south west to north east
+                       (1, -1)):  # diagonal: south east to north west
+        for idxrow in range(0, nrows):
+            for idxcol in range(0, ncols):
+                endrow = idxrow + (connect - 1) * drow
+                endcol = idxcol + (connect - 1) * dcol
+                if 0 <= endrow < nrows and 0 <= endcol < ncols:
+                    lines.append(tuple((idxrow + k * drow) * ncols + idxcol + k * dcol
+                                       for k in range(0, connect)))
+    celllines = [[] for field in range(0, nrows * ncols)]
+    for idxline, line in enumerate(lines):
+        for field in line:
+            celllines[field].append(idxline)
+    return tuple(lines), tuple(tuple(idxlines) for idxlines in celllines)
+
+
 class TicTacToe:
     '''
     TicTacToe board.
@@ -11,8 +57,12 @@ class TicTacToe:
         - sends rewards to players
         - knows a game-specific visualizer that it can ask to display state and messages
 
+        The state is communicated to the players as an integer "state code" (see state2code()),
+        which is cheap to hash, to store and to pickle. decodeState() turns it back into a board.
+        Together with the state, players get a mask of the legal actions (see legalActions()), so
+        they need not find out about invalid moves by trial and error.
+
         TODO: Use iterator instead of an index variable to indicate which player is the next.
-        TODO: Review how the state is communicated: who should make sure that it is a tuple?.
 
     '''
 
@@ -38,12 +88,29 @@ class TicTacToe:
     WIN_PL1 = 1
     DRAW = 2
 
-    def __init__(self):
+    # class-level constants for state codes: field idx is digit idx of a base-3 number
+    _POW3 = tuple(3 ** idx for idx in range(9))
+    EMPTY_CODE = 3 ** 9 - 1  # all digits are UNMARKED
+
+    # class-level constants for symmetries: field permutations, and the inverse permutations
+    SYMMETRIES = _d4permutations()
+    _INVERSE_SYMMETRIES = tuple(tuple(perm.index(idx) for idx in range(9)) for perm in SYMMETRIES)
+    _canonical = {}  # cache for canonicalize()
+
+    def __init__(self, masks=True):
+        '''
+        :param masks: If True, send players a mask of the legal actions with the state. If False,
+            players get None instead and learn about invalid moves from R_INVALID only.
+        '''
         self.winners = ((0, 1, 2), (3, 4, 5), (6, 7, 8),
                         (0, 3, 6), (1, 4, 7), (2, 5, 8),
                         (0, 4, 8), (6, 4, 2))
         self._boardstate = [TicTacToe.UNMARKED] * 9
+        self._statecode = TicTacToe.EMPTY_CODE
+        self._masks = masks
+        self._legal = (1 << 9) - 1
         self._status = TicTacToe.NOT_READY
+        self.instrumentation = None  # optional Instrumentation.GameInstrumentation
         self._whosturn = None
         self._previousturn = None
         self._players = None
@@ -55,11 +122,120 @@ class TicTacToe:
 
     def reset(self):
         self._boardstate = [TicTacToe.UNMARKED] * 9
+        self._statecode = TicTacToe.EMPTY_CODE
+        self._legal = (1 << 9) - 1
         self._whosturn = 0
         self._previousturn = None
         self._status = TicTacToe.READY
 
-    # TODO: define state2tuple and use it throughout when state is passed out
+    def state2tuple(self):
+        return tuple(self._boardstate)
+
+    def state2code(self):
+        return self._statecode
+
+    def legalActions(self):
+        '''
+        :return: Legal-action mask: bit idx is set if POSSIBLE_ACTIONS[idx] is a legal move
+        '''
+        return self._legal
+
+    def nmoves(self):
+        # number of stones on the board
+        return 9 - bin(self._legal).count('1')
+
+    @staticmethod
+    def encodeState(state):
+        '''
+        Encode a board (sequence of 9 field markers) as base-3 integer.
+        :param state: Board as returned by state2tuple()
+        :return: State code as returned by state2code()
+        '''
+        code = 0
+        for idx in range(8, -1, -1):
+            code = 3 * code + state[idx]
+        return code
+
+    @staticmethod
+    def decodeState(code):
+        '''
+        Inverse of encodeState().
+        :param code: State code as returned by state2code()
+        :return: Board as returned by state2tuple()
+        '''
+        state = []
+        for idx in range(0, 9):
+            code, marker = divmod(code, 3)
+            state.append(marker)
+        return tuple(state)
+
+    @staticmethod
+    def enumerateStates():
+        '''
+        Enumerate all boards that can be reached in a game, including terminal ones.
+        :return: Sorted list of state codes
+        '''
+        game = TicTacToe()
+        game.reset()
+        codes = set()
+
+        def visit():
+            # boards reached by different move orders have the same subtree
+            if game._statecode in codes:
+                return
+            codes.add(game._statecode)
+            for move in TicTacToe.POSSIBLE_ACTIONS:
+                if game.checkAndPlaceMove(move):
+                    game.checkwon()
+                    game.checkdraw()
+                    if game._status == TicTacToe.READY:
+                        game._whosturn = (game._whosturn + 1) % 2
+                        visit()
+                        game._whosturn = (game._whosturn + 1) % 2
+                    else:
+                        codes.add(game._statecode)
+                        game._status = TicTacToe.READY
+                    # undo move
+                    game._boardstate[move - 1] = TicTacToe.UNMARKED
+                    game._statecode -= (game._whosturn - TicTacToe.UNMARKED) * TicTacToe._POW3[move - 1]
+                    game._legal |= 1 << (move - 1)
+
+        visit()
+        return sorted(codes)
+
+    def canonicalize(self, code):
+        '''
+        Map a state to the representative of its class of rotated/reflected boards, so that a
+        learner needs to learn only one of them.
+        :param code: State code
+        :return: Tuple (canonical state code, index of the symmetry that maps code onto it)
+        '''
+        try:
+            return TicTacToe._canonical[code]
+        except KeyError:
+            state = TicTacToe.decodeState(code)
+            best = None
+            for t, perm in enumerate(TicTacToe.SYMMETRIES):
+                transformed = [None] * 9
+                for idx in range(0, 9):
+                    transformed[perm[idx]] = state[idx]
+                candidate = (TicTacToe.encodeState(transformed), t)
+                if best is None or candidate[0] < best[0]:
+                    best = candidate
+            TicTacToe._canonical[code] = best
+            return best
+
+    def transformAction(self, action, t):
+        '''
+        :return: The action in the canonical board that corresponds to "action" in the original
+        '''
+        return TicTacToe.SYMMETRIES[t][action - 1] + 1
+
+    def restoreAction(self, action, t):
+        '''
+        Inverse of transformAction().
+        '''
+        return TicTacToe._INVERSE_SYMMETRIES[t][action - 1] + 1
 
     def play(self):
         '''
@@ -81,33 +257,58 @@ class TicTacToe:
         :return:
         '''
 
+        # Optional per-phase timings, see Instrumentation.py
+        inst = self.instrumentation
+        if inst is not None:
+            t0 = inst.clock()
+
         # Request moves from players as long as the game as is not in terminal states
         while self._status == TicTacToe.READY:
             # Inform player ONCE about current state
-            self._players[self._whosturn].setState(tuple(self._boardstate))
+            legal = self._legal if self._masks else None
+            self._players[self._whosturn].setState(self._statecode, legal)
+            if inst is not None:
+                t0 = inst.lap('setState', t0)
 
             # Request move from active player as long as invalid moves are selected
             while 1:
                 move = self._players[self._whosturn].turn()
+                if inst is not None:
+                    t0 = inst.lap('turn', t0)
                 # Valid moves change the board state
-                if self.checkAndPlaceMove(move):
+                valid = self.checkAndPlaceMove(move)
+                if inst is not None:
+                    t0 = inst.lap('placeMove', t0)
+                if valid:
                     break
                 # Invalid moves get sanctioned with an instant bad reward
                 else:
                     self._players[self._whosturn].sendReward(TicTacToe.R_INVALID, None)
+                    if inst is not None:
+                        inst.invalidmoves += 1
+                        t0 = inst.lap('invalid', t0)
 
             # After each move, check for terminal states ("won", "draw")
             self.checkwon()
+            if inst is not None:
+                inst.moves += 1
+                t0 = inst.lap('checkwon', t0)
             self.checkdraw()
+            if inst is not None:
+                t0 = inst.lap('checkdraw', t0)
 
             # After each move, send rewards where appropriate
             self.checkRewards()
+            if inst is not None:
+                t0 = inst.lap('checkRewards', t0)
 
             # After each move, ask players if they want to see the state,
             # This obviously informs players also about the final state
             for player in self._players:
                 if player.watchesState:
-                    player.setState(self._boardstate)
+                    player.setState(self._statecode, self._legal if self._masks else None)
+            if inst is not None:
+                t0 = inst.lap('watchers', t0)
 
             # give turn to next player in cycle
             self._previousturn = self._whosturn
@@ -128,6 +329,9 @@ class TicTacToe:
         # Let the players do "clean up" operations
         for player in self._players:
             player.finalize()
+        if inst is not None:
+            inst.games += 1
+            inst.lap('finalize', t0)
 
     def checkRewards(self):
         '''
@@ -147,7 +351,7 @@ class TicTacToe:
             # reward because his move might turn out to be a bad one.
             if self._previousturn is not None:
                 self._players[self._previousturn].sendReward(TicTacToe.R_DEFAULT,
-                                                             tuple(self._boardstate))
+                                                             self._statecode)
         elif self._status == TicTacToe.WIN_PL0 or self._status == TicTacToe.WIN_PL1:
             # There is a winner, i.e. the current player's move was a winning move
             winner = self._status
@@ -174,8 +378,10 @@ class TicTacToe:
                 # illegal move
                 return False
             else:
-                # legal move: change state
+                # legal move: change state and state code (digit changes from UNMARKED to player)
                 self._boardstate[move - 1] = self._whosturn
+                self._statecode += (self._whosturn - TicTacToe.UNMARKED) * TicTacToe._POW3[move - 1]
+                self._legal &= ~(1 << (move - 1))
                 return True
 
     def checkwon(self):
@@ -209,12 +415,21 @@ class VierGewinnt:
     MARKED_PL0 = 0
     MARKED_PL1 = 1
     UNMARKED = 2
+
+    # class-level defaults for the board size; every instance has its own NROWS, NCOLS, CONNECT,
+    # POSSIBLE_ACTIONS and EMPTY_CODE
     NCOLS = 5
     NROWS = 5
+    CONNECT = 4
 
     # class-level constant for possible actions
     POSSIBLE_ACTIONS = range(1, NCOLS+1)
 
+    # class-level constant for state codes: the 1-markers sit in the bottom row
+    EMPTY_CODE = int(('0' * NROWS + '1') * NCOLS, 2)
+
+    _lines = {}  # cache of _winninglines() per board size
+
     # class level game status constant
     NOT_READY = -2
     READY = -1
@@ -222,25 +437,69 @@ class VierGewinnt:
     WIN_PL1 = 1
     DRAW = 2
 
-    def __init__(self):
-        # note that the first index is for column, the second for row
-        self._boardstate = [[VierGewinnt.UNMARKED for j in range(self.NCOLS)] for i in range(self.NROWS)]
-        self._winner = ((( 0, -3), ( 0, -2), ( 0, -1)),  # west
-                        ((-3, -3), (-2, -2), (-1, -1)),  # south west
-                        ((-3,  0), (-2,  0), (-1,  0)),  # south
-                        ((-3,  3), (-2,  2), (-1,  1)),  # south east
-                        (( 0,  3), ( 0,  2), ( 0,  1)),  # east
-                        (( 0,  1), ( 0, -2), ( 0, -1)),  # mostly west
-                        (( 0, -1), ( 0,  2), ( 0,  1)),  # mostly east
-                        (( 3, -3), ( 2, -2), ( 1, -1)),  # north west
-                        (( 2, -2), ( 1, -1), (-1,  1)),  # mostly north west
-                        (( 1, -1), (-1,  1), (-2,  2)),  # mostly south east
-                        (( 3,  3), ( 2,  2), ( 1,  1)),  # north east
-                        (( 2,  2), ( 1,  1), (-1, -1)),  # mostly north east
-                        (( 1,  1), (-1, -1), (-2, -2)))  # mostly south west
+    # state codes are stored as int64 by Experience, ReplayBuffer, MappedQStore and BatchGames
+    MAXBITS = 63
 
+    def __init__(self, nrows=NROWS, ncols=NCOLS, connect=CONNECT, bitboard=False, masks=True):
+        '''
+        :param nrows: Number of rows, e.g. 6 for the standard board
+        :param ncols: Number of columns, e.g. 7 for the standard board. The state code takes
+            ncols * (nrows + 1) bits, at most MAXBITS, e.g. 7 x 6 or 8 x 6 but not 8 x 7.
+        :param connect: Number of stones in a row that win the game
+        :param bitboard: If True, keep each player's stones as one integer ("bitboard") and use
+            shift-and-mask operations in checkwon() and line masks in checkdraw() instead of the
+            stone counts of the winning lines, which are not kept then.
+        :param masks: If True, send players a mask of the legal actions with the state. If False,
+            players get None instead and learn about invalid moves from R_INVALID only.
+        '''
+        if ncols * (nrows + 1) > VierGewinnt.MAXBITS:
+            raise ValueError('The state code of a {:d} x {:d} board takes {:d} bits, more than {:d}'
+                             .format(ncols, nrows, ncols * (nrows + 1), VierGewinnt.MAXBITS))
+        self.NROWS = nrows
+        self.NCOLS = ncols
+        self.CONNECT = connect
+        self.POSSIBLE_ACTIONS = range(1, ncols+1)
+        self.EMPTY_CODE = int(('0' * nrows + '1') * ncols, 2)
+
+        # note that the first index is for row, the second for column
+        self._boardstate = [[VierGewinnt.UNMARKED for j in range(self.NCOLS)] for i in range(self.NROWS)]
         self._column_cnt = [0] * self.NCOLS
+        self._masks = masks
+        self._legal = (1 << ncols) - 1  # bit idxcol is set while the column is not full
+
+        # Every line of CONNECT fields keeps a count of the stones of each player in it, so a move
+        # can only complete one of the (at most 4 * CONNECT) lines through its field.
+        # A line is "open" for a player as long as the opponent has no stone in it; when no line
+        # is open for either player, the game can not be won any more.
+        size = (nrows, ncols, connect)
+        if size not in VierGewinnt._lines:
+            VierGewinnt._lines[size] = _winninglines(nrows, ncols, connect)
+        self._winninglines, self._celllines = VierGewinnt._lines[size]
+        self._linecnt = [[0] * len(self._winninglines), [0] * len(self._winninglines)]
+        self._openlines = [len(self._winninglines), len(self._winninglines)]
+
+        # Bitboard layout: bit (idxcol * (NROWS + 1) + idxrow) is set if the player has a stone in
+        # that field. The extra (always empty) bit on top of each column keeps shifted lines from
+        # wrapping around into the next column.
+        self._bitboard = bitboard
+        self._bitboards = [0, 0]
+        self._statecode = self.EMPTY_CODE
+        h1 = self.NROWS + 1
+        # bitboard of each winning line, and the first line that may still be open (lines only
+        # ever close during a game, so checkdraw() never has to look at the ones before)
+        self._linemasks = [sum(1 << ((field % ncols) * h1 + field // ncols) for field in line)
+                           for line in self._winninglines]
+        self._firstopen = 0
+        # the masks of the lines through each field, for checkwon()
+        self._cellmasks = [tuple(self._linemasks[idxline] for idxline in idxlines)
+                           for idxlines in self._celllines]
+        self._bbshifts = (1,       # vertical
+                          h1,      # horizontal
+                          h1 - 1,  # diagonal: south east to north west
+                          h1 + 1)  # diagonal: south west to north east
+
         self._status = VierGewinnt.NOT_READY
+        self.instrumentation = None  # optional Instrumentation.GameInstrumentation
         self._whosturn = None
         self._previousturn = None
         self._players = None
@@ -248,17 +507,109 @@ class VierGewinnt:
     def state2tuple(self):
         return tuple([tuple(col) for col in self._boardstate])
 
+    def state2code(self):
+        return self._statecode
+
+    def legalActions(self):
+        '''
+        :return: Legal-action mask: bit idx is set if POSSIBLE_ACTIONS[idx] is a legal move
+        '''
+        return self._legal
+
+    def nmoves(self):
+        # number of stones on the board
+        return sum(self._column_cnt)
+
+    @staticmethod
+    def encodeState(state, nrows=NROWS, ncols=NCOLS):
+        '''
+        Encode a board as packed integer.
+        Each column occupies (nrows + 1) bits, using the bitboard layout. Bits below the height of
+        the column are 1 for stones of player 1 and 0 for stones of player 0, the bit at the height
+        of the column is a 1-marker, bits above are 0.
+        This is "player-1-bitboard + occupied fields + bottom row", which changes by
+        (1 + player) << bit on every move and can hence be updated incrementally.
+        :param state: Board as returned by state2tuple()
+        :return: State code as returned by state2code()
+        '''
+        code = 0
+        for idxcol in range(0, ncols):
+            offset = idxcol * (nrows + 1)
+            idxrow = 0
+            while idxrow < nrows and state[idxrow][idxcol] != VierGewinnt.UNMARKED:
+                if state[idxrow][idxcol] == VierGewinnt.MARKED_PL1:
+                    code |= 1 << (offset + idxrow)
+                idxrow += 1
+            code |= 1 << (offset + idxrow)
+        return code
+
+    @staticmethod
+    def decodeState(code, nrows=NROWS, ncols=NCOLS):
+        '''
+        Inverse of encodeState().
+        :param code: State code as returned by state2code()
+        :return: Board as returned by state2tuple()
+        '''
+        state = [[VierGewinnt.UNMARKED] * ncols for i in range(nrows)]
+        colmask = (1 << (nrows + 1)) - 1
+        for idxcol in range(0, ncols):
+            bits = (code >> (idxcol * (nrows + 1))) & colmask
+            height = bits.bit_length() - 1
+            for idxrow in range(0, height):
+                state[idxrow][idxcol] = (bits >> idxrow) & 1
+        return tuple([tuple(row) for row in state])
+
+    def canonicalize(self, code):
+        '''
+        Map a state to the representative of the pair {board, mirrored board}, so that a
+        learner needs to learn only one of them.
+        :param code: State code
+        :return: Tuple (canonical state code, 0 if it is the original or 1 if it is mirrored)
+        '''
+        # mirroring reverses the order of the column fields in the code
+        h1 = self.NROWS + 1
+        colmask = (1 << h1) - 1
+        mirrored = 0
+        rest = code
+        for idxcol in range(0, self.NCOLS):
+            mirrored = (mirrored << h1) | (rest & colmask)
+            rest >>= h1
+        if mirrored < code:
+            return mirrored, 1
+        else:
+            return code, 0
+
+    def transformAction(self, action, t):
+        '''
+        :return: The action in the canonical board that corresponds to "action" in the original
+        '''
+        if t:
+            return self.NCOLS + 1 - action
+        return action
+
+    def restoreAction(self, action, t):
+        '''
+        Inverse of transformAction().
+        '''
+        return self.transformAction(action, t)
+
     def setplayers(self, players):
         self._players = players
         self._whosturn = 0
         self._status = VierGewinnt.READY
 
     def reset(self):
-        # TODO: remove stupid double loop
         self._boardstate = \
-            [[VierGewinnt.UNMARKED for j in range(self.NCOLS)] for i in range(self.NCOLS)]
+            [[VierGewinnt.UNMARKED for j in range(self.NCOLS)] for i in range(self.NROWS)]
         self._column_cnt = [0] * self.NCOLS
+        self._legal = (1 << self.NCOLS) - 1
+        self._linecnt = [[0] * len(self._winninglines), [0] * len(self._winninglines)]
+        self._openlines = [len(self._winninglines), len(self._winninglines)]
+        self._bitboards = [0, 0]
+        self._firstopen = 0
+        self._statecode = self.EMPTY_CODE
         self._whosturn = 0
+        self._previousturn = None
         self._status = VierGewinnt.READY
 
     def play(self):
@@ -282,17 +633,30 @@ class VierGewinnt:
         :return:
         '''
 
+        # Optional per-phase timings, see Instrumentation.py
+        inst = self.instrumentation
+        if inst is not None:
+            t0 = inst.clock()
+
         # Request moves from players as long as the game as is not in terminal states
         while self._status == VierGewinnt.READY:
             # Inform player ONCE about current state
-            self._players[self._whosturn].setState(self.state2tuple())
+            legal = self._legal if self._masks else None
+            self._players[self._whosturn].setState(self._statecode, legal)
+            if inst is not None:
+                t0 = inst.lap('setState', t0)
 
             # Request move from active player as long as invalid moves are selected
             cntInvalid = 0
             while 1:
                 move = self._players[self._whosturn].turn()
+                if inst is not None:
+                    t0 = inst.lap('turn', t0)
                 # Valid moves change the board state
-                if self.checkAndPlaceMove(move):
+                valid = self.checkAndPlaceMove(move)
+                if inst is not None:
+                    t0 = inst.lap('placeMove', t0)
+                if valid:
                     break
                 # Invalid moves get sanctioned with an instant bad reward
                 else:
@@ -301,19 +665,31 @@ class VierGewinnt:
                         print(self._boardstate)
                         raise Exception('Endless loop')
                     self._players[self._whosturn].sendReward(VierGewinnt.R_INVALID, None)
+                    if inst is not None:
+                        inst.invalidmoves += 1
+                        t0 = inst.lap('invalid', t0)
 
             # After each move, check for terminal states ("won", "draw")
             self.checkwon(move)
+            if inst is not None:
+                inst.moves += 1
+                t0 = inst.lap('checkwon', t0)
             self.checkdraw()
+            if inst is not None:
+                t0 = inst.lap('checkdraw', t0)
 
             # After each move, send rewards where appropriate
             self.checkRewards()
+            if inst is not None:
+                t0 = inst.lap('checkRewards', t0)
 
             # After each move, ask players if they want to see the state,
             # This obviously informs players also about the final state
             for player in self._players:
                 if player.watchesState:
-                    player.setState(self.state2tuple())
+                    player.setState(self._statecode, self._legal if self._masks else None)
+            if inst is not None:
+                t0 = inst.lap('watchers', t0)
 
             # give turn to next player in cycle
             self._previousturn = self._whosturn
@@ -335,6 +711,9 @@ class VierGewinnt:
         # Let the players do "clean up" operations
         for player in self._players:
             player.finalize()
+        if inst is not None:
+            inst.games += 1
+            inst.lap('finalize', t0)
 
     def checkRewards(self):
         '''
@@ -361,7 +740,7 @@ class VierGewinnt:
             # reward because his move might turn out to be a bad one.
             if self._previousturn is not None:
                 self._players[self._previousturn].sendReward(VierGewinnt.R_DEFAULT,
-                                                             self.state2tuple())
+                                                             self._statecode)
         elif self._status == VierGewinnt.WIN_PL0 or self._status == VierGewinnt.WIN_PL1:
             # There is a winner, i.e. the current player's move was a winning move
             winner = self._status
@@ -374,7 +753,7 @@ class VierGewinnt:
                 player.sendReward(VierGewinnt.R_DRAW, None)
 
     def returnState(self):
-        return self.state2tuple()
+        return self._statecode
 
     def checkAndPlaceMove(self, move):
         '''
@@ -382,7 +761,7 @@ class VierGewinnt:
         :param move: The field number selected by the player
         :return: Bool that indicates whether the move was valid or not
         '''
-        if move not in VierGewinnt.POSSIBLE_ACTIONS:
+        if move not in self.POSSIBLE_ACTIONS:
             return False
         else:
             idxcol = move - 1
@@ -394,38 +773,67 @@ class VierGewinnt:
                 # legal move: change state and auxiliary state variable
                 self._boardstate[idxrow][idxcol] = self._whosturn
                 self._column_cnt[idxcol] += 1
+                if idxrow == self.NROWS - 1:
+                    self._legal &= ~(1 << idxcol)
+                bit = 1 << (idxcol * (self.NROWS + 1) + idxrow)
+                self._statecode += (1 + self._whosturn) * bit
+                if self._bitboard:
+                    self._bitboards[self._whosturn] |= bit
+                    return True
+                # the first stone in a line closes it for the opponent
+                linecnt = self._linecnt[self._whosturn]
+                for idxline in self._celllines[idxrow * self.NCOLS + idxcol]:
+                    if linecnt[idxline] == 0:
+                        self._openlines[1 - self._whosturn] -= 1
+                    linecnt[idxline] += 1
                 return True
 
     # TODO: is the lastmove variable really needed? It does speed things up. Use instance state?
     def checkwon(self, lastmove):
-        # find location of last set stone and try all variants around it
+        if self._bitboard:
+            self._checkwonBitboard(lastmove)
+            return
+        # find location of last set stone: only lines through it can have been completed
         idxcol = lastmove - 1
         idxrow = self._column_cnt[idxcol]-1
         player = self._boardstate[idxrow][idxcol]
-        for shifts in self._winner:
-            won = True
-            for shift in shifts:
-                try:
-                    i = idxrow + shift[0]
-                    j = idxcol + shift[1]
-                    if i < 0 or i >= self.NROWS or j < 0 or j >= self.NCOLS:
-                        raise IndexError
-                    if self._boardstate[i][j] != player:
-                        won = False
-                        break
-                except IndexError:
-                    won = False
-                    break
-            if won:
-                # for at least one of the tested set of shifts (e.g. a south west diagonal),
-                # we could not find a wrong stone --> a win by the "player" who put the last stone
+        linecnt = self._linecnt[player]
+        for idxline in self._celllines[idxrow * self.NCOLS + idxcol]:
+            if linecnt[idxline] == self.CONNECT:
+                self._status = player
+                break
+
+    def _checkwonBitboard(self, lastmove):
+        '''
+        Bitboard version of checkwon(): Only the player who just moved can have won, with one of
+        the lines through the last stone, i.e. if the player's bitboard covers its mask. Unlike
+        the stone counts, this needs no bookkeeping when a stone is placed.
+        :return:
+        '''
+        player = self._whosturn
+        bb = self._bitboards[player]
+        idxcol = lastmove - 1
+        for mask in self._cellmasks[(self._column_cnt[idxcol] - 1) * self.NCOLS + idxcol]:
+            if bb & mask == mask:
                 self._status = player
                 break
 
     def checkdraw(self):
         if self._status == VierGewinnt.READY:
-            # if full, it is a draw
-            # refined version: prematurely stop game with "draw", if it can not be won any more
-            if all(c == VierGewinnt.NROWS for c in self._column_cnt):
+            # if nobody can complete a line any more, it is a draw (at the latest when the board is
+            # full)
+            if self._bitboard:
+                # a line is open for a player as long as the opponent has no stone in it, i.e.
+                # while it misses the stones of one of the players
+                bb0, bb1 = self._bitboards
+                linemasks = self._linemasks
+                idx = self._firstopen
+                while idx < len(linemasks) and bb0 & linemasks[idx] and bb1 & linemasks[idx]:
+                    idx += 1
+                self._firstopen = idx
+                draw = idx == len(linemasks)
+            else:
+                draw = self._openlines[0] == 0 and self._openlines[1] == 0
+            if draw:
                 # this is a draw: log
                 self._status = VierGewinnt.DRAW
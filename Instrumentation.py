@@ -0,0 +1,71 @@
+import json
+import time
+
+
+class GameInstrumentation:
+    '''
+    Per-phase timings and counters for the game loop.
+    Attach an instance to a game (and optionally to a Qlearner) via their "instrumentation"
+    attribute. When the attribute is None, which is the default, the game loop only pays for a
+    few "is not None" checks per move.
+
+    Phases of play():
+        setState:  informing the player whose turn it is about the state
+        turn:      the player's turn(), i.e. action selection
+        placeMove: checkAndPlaceMove()
+        invalid:   sending R_INVALID for invalid moves
+        checkwon, checkdraw, checkRewards: terminal state checks and rewards
+        watchers:  state updates for players who watch the state
+        finalize:  messages and players' finalize(), e.g. batch learning
+    '''
+
+    PHASES = ('setState', 'turn', 'placeMove', 'invalid', 'checkwon', 'checkdraw', 'checkRewards',
+              'watchers', 'finalize')
+
+    clock = time.perf_counter
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.games = 0
+        self.moves = 0
+        self.invalidmoves = 0
+        self.qupdates = 0
+
+    def lap(self, phase, t0):
+        '''
+        Add the time since t0 to phase.
+        :return: The current time, i.e. t0 for the next phase
+        '''
+        t = self.clock()
+        self.times[phase] += t - t0
+        return t
+
+    def summary(self):
+        total = sum(self.times.values())
+        games = max(self.games, 1)
+        return {'games': self.games,
+                'moves/game': self.moves / games,
+                'invalid moves/game': self.invalidmoves / games,
+                'Q updates/game': self.qupdates / games,
+                'sec': total,
+                'sec per phase': dict(self.times),
+                'share per phase': {phase: t / total if total > 0 else 0.0
+                                    for phase, t in self.times.items()}}
+
+    def report(self):
+        summary = self.summary()
+        lines = ['{:d} games, {:.1f} moves/game, {:.2f} invalid moves/game, {:.1f} Q updates/game'
+                 .format(summary['games'], summary['moves/game'], summary['invalid moves/game'],
+                         summary['Q updates/game'])]
+        for phase in self.PHASES:
+            lines.append('  {:13s} {:8.3f} sec {:6.1%}'.format(
+                phase, summary['sec per phase'][phase], summary['share per phase'][phase]))
+        return '\n'.join(lines)
+
+    def dump(self, f):
+        # one JSON object per line
+        f.write(json.dumps(self.summary()) + '\n')
+        f.flush()
@@ -1,64 +1,838 @@
 import pickle
 import os
+import math
+import copy
+import tempfile
+import warnings
+import threading
 import numpy as np
 
+from Experience import NONE
+
+
+def _writeAtomically(dstfile, save):
+    '''
+    Write a file via a temporary file in the same directory, so that a crash never leaves a
+    half-written dstfile and processes that read or map the old dstfile are not disturbed.
+    The temporary file has a unique name, so concurrent writers don't get in each other's way.
+    :param save: Function that writes the file, called with the name of the temporary file
+    '''
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dstfile)),
+                                   prefix=os.path.basename(dstfile) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        save(tmpfile)
+        with open(tmpfile, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmpfile, dstfile)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+
+class PairQStore:
+    '''
+    Q-values stored per state-action pair, i.e. as dict {(S, a): Q}.
+    This is the original storage format of Qlearner.
+    '''
+
+    def __init__(self, possibleActions, default_reward):
+        self._possibleActions = possibleActions
+        self._defaultreward = default_reward
+        self._knownQs = {}
+
+    def __len__(self):
+        return len(self._knownQs)
+
+    def states(self):
+        return set(S for (S, a) in self._knownQs)
+
+    def get(self, S, a):
+        try:
+            return self._knownQs[(S, a)]
+        except KeyError:
+            return self._defaultreward
+
+    def values(self, S):
+        return np.array([self.get(S, a) for a in self._possibleActions])
+
+    def maxQ(self, S):
+        return max([self.get(S, a) for a in self._possibleActions])
+
+    def valuesMany(self, states):
+        return np.array([self.values(S) for S in states]).reshape(-1, len(self._possibleActions))
+
+    def set(self, S, a, q):
+        self._knownQs[(S, a)] = q
+
+    def setMany(self, states, actionIndices, qs):
+        for S, idxa, q in zip(states, actionIndices, qs):
+            self._knownQs[(S, self._possibleActions[idxa])] = float(q)
+
+    def load(self, Qfile):
+        with open(Qfile, 'rb') as rfp:
+            self._knownQs = pickle.load(rfp)
+
+    def save(self, Qfile):
+        with open(Qfile, 'wb') as wfp:
+            pickle.dump(self._knownQs, wfp)
+
+
+class RowQStore:
+    '''
+    Q-values stored per state: a dict {S: row index} into one matrix with the Qs of all possible
+    actions in its columns. Compared to PairQStore, every state is stored once instead of once per
+    action, and looking up all Qs of a state is a single dict lookup that returns a vector.
+    Qfiles in the PairQStore format are converted when loaded, see pairs2rows().
+    '''
+
+    def __init__(self, possibleActions, default_reward, dtype=np.float32, encodeState=None,
+                 symmetry=None):
+        '''
+        :param encodeState, symmetry: Only used to convert Qfiles in the PairQStore format with
+            states that are not state codes yet, see pairs2rows(). Typically the game's
+            encodeState and, if the Qlearner uses one, its symmetry.
+        '''
+        self._possibleActions = possibleActions
+        self._encodeState = encodeState
+        self._symmetry = symmetry
+        self._actionIndex = {a: idx for idx, a in enumerate(possibleActions)}
+        self._defaultreward = default_reward
+        self._dtype = dtype
+        # returned for unknown states, must never be written to
+        self._defaultrow = np.full(len(possibleActions), default_reward, dtype=dtype)
+        self._defaultrow.setflags(write=False)
+        self._index = {}
+        self._Q = np.empty((1024, len(possibleActions)), dtype=dtype)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getstate__(self):
+        # don't pickle the unused capacity of Q, e.g. when sending the store to another process
+        state = self.__dict__.copy()
+        state['_Q'] = self._Q[:len(self._index)]
+        return state
+
+    def states(self):
+        return self._index.keys()
+
+    def _addrow(self, S):
+        idx = len(self._index)
+        if idx == self._Q.shape[0]:
+            # grow geometrically to keep appending amortized O(1)
+            self._Q = np.concatenate((self._Q, np.empty((max(idx, 1024), self._Q.shape[1]),
+                                                        dtype=self._dtype)))
+        self._Q[idx] = self._defaultreward
+        self._index[S] = idx
+        return idx
+
+    def get(self, S, a):
+        idx = self._index.get(S)
+        if idx is None:
+            return self._defaultreward
+        return float(self._Q[idx, self._actionIndex[a]])
+
+    def values(self, S):
+        idx = self._index.get(S)
+        if idx is None:
+            return self._defaultrow
+        return self._Q[idx]
+
+    def maxQ(self, S):
+        idx = self._index.get(S)
+        if idx is None:
+            return self._defaultreward
+        return float(self._Q[idx].max())
+
+    def valuesMany(self, states):
+        '''
+        :param states: Iterable of states
+        :return: Matrix with the Qs of all possible actions, one row per state
+        '''
+        index = self._index
+        rows = np.fromiter((index.get(S, -1) for S in states), dtype=np.intp)
+        Q = self._Q[rows]
+        Q[rows < 0] = self._defaultreward
+        return Q
+
+    def set(self, S, a, q):
+        idx = self._index.get(S)
+        if idx is None:
+            idx = self._addrow(S)
+        self._Q[idx, self._actionIndex[a]] = q
+
+    def setMany(self, states, actionIndices, qs):
+        '''
+        Vectorized set(). If a state-action pair occurs more than once, one of its qs wins.
+        :param actionIndices: Index of each action in possibleActions
+        '''
+        index = self._index
+        rows = []
+        for S in states:
+            idx = index.get(S)
+            if idx is None:
+                idx = self._addrow(S)
+            rows.append(idx)
+        self._Q[rows, actionIndices] = qs
+
+    def load(self, Qfile):
+        with open(Qfile, 'rb') as rfp:
+            table = pickle.load(rfp)
+        if isinstance(table, dict):
+            # PairQStore format
+            table = pairs2rows(table, self._possibleActions, self._defaultreward, self._dtype,
+                               self._encodeState, self._symmetry)
+        self._index, self._Q = table
+
+    def save(self, Qfile):
+        with open(Qfile, 'wb') as wfp:
+            pickle.dump((self._index, self._Q[:len(self._index)]), wfp)
+
+
+class DenseQStore(RowQStore):
+    '''
+    Q-values for a game with a small, known set of states (e.g. TicTacToe.enumerateStates()):
+    one contiguous matrix with a row for every state, allocated once. The state -> row index is
+    fixed, so the Qfile is just the matrix, stored as .npy file and read without unpickling.
+    '''
+
+    def __init__(self, states, possibleActions, default_reward, dtype=np.float32):
+        RowQStore.__init__(self, possibleActions, default_reward, dtype)
+        self._index = {S: idx for idx, S in enumerate(states)}
+        self._Q = np.full((len(self._index), len(possibleActions)), default_reward, dtype=dtype)
+
+    def _addrow(self, S):
+        raise KeyError('Unknown state {}'.format(S))
+
+    def valuesMany(self, states):
+        return self._Q[self.rows(states)]
+
+    def setMany(self, states, actionIndices, qs):
+        self._Q[self.rows(states), actionIndices] = qs
+
+    def rows(self, states):
+        '''
+        :param states: Iterable of states
+        :return: Array with the row index of each state, e.g. for fancy indexing into Q
+        '''
+        return np.fromiter((self._index[S] for S in states), dtype=np.intp)
+
+    def load(self, Qfile):
+        Q = np.load(Qfile)
+        if Q.shape != self._Q.shape:
+            raise ValueError('Qfile has shape {}, expected {}'.format(Q.shape, self._Q.shape))
+        self._Q = Q.astype(self._dtype, copy=False)
+
+    def save(self, Qfile):
+        # write to file object, np.save() would append ".npy" to file names without it
+        with open(Qfile, 'wb') as wfp:
+            np.save(wfp, self._Q)
+
+
+class BoundedQStore(RowQStore):
+    '''
+    RowQStore with a fixed maximal number of states, for long training runs under a fixed memory
+    budget. Every lookup or update of a state counts as a visit. When the store is full, the
+    states with the fewest visits are evicted (a fraction evictFraction of the capacity at a time),
+    i.e. their Qs fall back to default_reward. After each eviction all visit counts are halved, so
+    that states which were visited often a long time ago can become cold again.
+    hits, misses and evictions are counted, see stats().
+    '''
+
+    def __init__(self, capacity, possibleActions, default_reward, dtype=np.float32,
+                 evictFraction=0.1, encodeState=None, symmetry=None):
+        RowQStore.__init__(self, possibleActions, default_reward, dtype, encodeState, symmetry)
+        self._capacity = capacity
+        self._nevict = max(1, int(capacity * evictFraction))
+        self._Q = np.empty((capacity, len(possibleActions)), dtype=dtype)
+        self._visits = np.zeros(capacity, dtype=np.uint32)
+        self._states = [None] * capacity  # row index -> state
+        self._freerows = list(range(capacity - 1, -1, -1))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        # rows are not contiguous after evictions, so keep the whole matrix
+        return self.__dict__.copy()
+
+    def stats(self):
+        return {'states': len(self._index), 'capacity': self._capacity, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def _lookup(self, S):
+        idx = self._index.get(S)
+        if idx is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._visits[idx] += 1
+        return idx
+
+    def _addrow(self, S):
+        if not self._freerows:
+            self._evict()
+        idx = self._freerows.pop()
+        self._Q[idx] = self._defaultreward
+        self._visits[idx] = 1
+        self._states[idx] = S
+        self._index[S] = idx
+        return idx
+
+    def _evict(self):
+        cold = np.argpartition(self._visits, self._nevict - 1)[:self._nevict]
+        for idx in cold.tolist():
+            del self._index[self._states[idx]]
+            self._states[idx] = None
+            self._freerows.append(idx)
+        self._visits >>= 1
+        self.evictions += len(cold)
+
+    def get(self, S, a):
+        idx = self._lookup(S)
+        if idx is None:
+            return self._defaultreward
+        return float(self._Q[idx, self._actionIndex[a]])
+
+    def values(self, S):
+        idx = self._lookup(S)
+        if idx is None:
+            return self._defaultrow
+        return self._Q[idx]
+
+    def maxQ(self, S):
+        idx = self._lookup(S)
+        if idx is None:
+            return self._defaultreward
+        return float(self._Q[idx].max())
+
+    def set(self, S, a, q):
+        idx = self._lookup(S)
+        if idx is None:
+            idx = self._addrow(S)
+        self._Q[idx, self._actionIndex[a]] = q
+
+    def setMany(self, states, actionIndices, qs):
+        # one at a time: adding a row may evict rows that were looked up before
+        for S, idxa, q in zip(states, actionIndices, qs):
+            self.set(S, self._possibleActions[idxa], q)
+
+    def load(self, Qfile):
+        loaded = RowQStore(self._possibleActions, self._defaultreward, self._dtype,
+                           self._encodeState, self._symmetry)
+        loaded.load(Qfile)
+        for S, idx in loaded._index.items():
+            row = self._index.get(S)
+            if row is None:
+                row = self._addrow(S)
+            self._Q[row] = loaded._Q[idx]
+
+    def save(self, Qfile):
+        rows = list(self._index.values())
+        index = dict(zip(self._index.keys(), range(len(rows))))
+        with open(Qfile, 'wb') as wfp:
+            pickle.dump((index, self._Q[rows]), wfp)
+
+
+class MappedQStore:
+    '''
+    Read-only Q-values in a compiled Qfile (see compileQfile()), for playing with a trained
+    Q-table: the file holds the sorted state codes and the matrix of their Qs, as two .npy arrays
+    one after the other, which are memory-mapped instead of read. Startup takes no time, a lookup
+    is a binary search that only touches a few pages, and processes that serve the same Qfile
+    share its pages in the OS page cache. State codes must be integers, i.e. the codes the games send.
+    '''
+
+    def __init__(self, possibleActions, default_reward):
+        self._possibleActions = possibleActions
+        self._actionIndex = {a: idx for idx, a in enumerate(possibleActions)}
+        self._defaultreward = default_reward
+        self._defaultrow = np.full(len(possibleActions), default_reward, dtype=np.float32)
+        self._defaultrow.setflags(write=False)
+        self._Qfile = None
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._Q = np.zeros((0, len(possibleActions)), dtype=np.float32)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getstate__(self):
+        # send the file name to other processes, not the contents; they map the file themselves
+        state = self.__dict__.copy()
+        del state['_keys'], state['_Q']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._Q = np.zeros((0, len(self._possibleActions)), dtype=np.float32)
+        if self._Qfile is not None:
+            self.load(self._Qfile)
+
+    def states(self):
+        return self._keys.tolist()
+
+    def _row(self, S):
+        idx = int(self._keys.searchsorted(S))
+        if idx < len(self._keys) and self._keys[idx] == S:
+            return idx
+        return None
+
+    def get(self, S, a):
+        idx = self._row(S)
+        if idx is None:
+            return self._defaultreward
+        return float(self._Q[idx, self._actionIndex[a]])
+
+    def values(self, S):
+        idx = self._row(S)
+        if idx is None:
+            return self._defaultrow
+        return self._Q[idx]
+
+    def maxQ(self, S):
+        idx = self._row(S)
+        if idx is None:
+            return self._defaultreward
+        return float(self._Q[idx].max())
+
+    def valuesMany(self, states):
+        states = np.fromiter(states, dtype=np.int64)
+        if len(self._keys) == 0:
+            return np.full((len(states), len(self._possibleActions)), self._defaultreward,
+                           dtype=np.float32)
+        rows = np.minimum(self._keys.searchsorted(states), len(self._keys) - 1)
+        Q = np.array(self._Q[rows])
+        Q[self._keys[rows] != states] = self._defaultreward
+        return Q
+
+    def set(self, S, a, q):
+        raise ValueError('MappedQStore is read-only, learn with a RowQStore and compile it')
+
+    def setMany(self, states, actionIndices, qs):
+        raise ValueError('MappedQStore is read-only, learn with a RowQStore and compile it')
+
+    def load(self, Qfile):
+        arrays = []
+        with open(Qfile, 'rb') as f:
+            for i in range(2):
+                if np.lib.format.read_magic(f) == (1, 0):
+                    shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+                offset = f.tell()
+                arrays.append(np.memmap(Qfile, dtype, 'r', offset, shape))
+                f.seek(offset + arrays[-1].nbytes)
+        keys, Q = arrays
+        if Q.shape != (len(keys), len(self._actionIndex)):
+            raise ValueError('{} is not a compiled Qfile for {} actions'.format(
+                Qfile, len(self._actionIndex)))
+        self._Qfile = Qfile
+        self._keys = keys
+        self._Q = Q
+
+    def save(self, Qfile):
+        # the Qs never change, so there is nothing to save
+        if Qfile != self._Qfile:
+            raise ValueError('MappedQStore is read-only, see compileQfile()')
+
+
+def compileQfile(srcfile, dstfile, possibleActions, default_reward, dtype=np.float32,
+                 encodeState=None, symmetry=None):
+    '''
+    Compile a Qfile in RowQStore (or PairQStore) format for MappedQStore. The Q-table is restored
+    like Qlearner does it, i.e. including the checkpoint logs of srcfile.
+    :param dtype: Data type of the Qs in the compiled file
+    :param encodeState, symmetry: See pairs2rows(), for Qfiles in the PairQStore format
+    :return: Number of states
+    '''
+    store = RowQStore(possibleActions, default_reward, dtype, encodeState, symmetry)
+    Qlearner(srcfile, possibleActions, default_reward, alpha=0.0, lam=0.0, store=store)
+    keys = np.fromiter(store._index.keys(), dtype=np.int64, count=len(store._index))
+    rows = np.fromiter(store._index.values(), dtype=np.intp, count=len(store._index))
+    order = np.argsort(keys)
+
+    def save(tmpfile):
+        with open(tmpfile, 'wb') as wfp:
+            np.save(wfp, keys[order])
+            np.save(wfp, np.ascontiguousarray(store._Q[rows[order]]))
+    # processes may have the old dstfile mapped
+    _writeAtomically(dstfile, save)
+    return len(keys)
+
+
+def pairs2rows(knownQs, possibleActions, default_reward, dtype=np.float32, encodeState=None,
+               symmetry=None):
+    '''
+    Convert a Q-table in PairQStore format to RowQStore format.
+    :param knownQs: dict {(S, a): Q}
+    :param encodeState: Function that is applied to all states that are not state codes yet, e.g.
+        TicTacToe.encodeState for Q-tables that were learned before the games sent state codes
+        instead of tuples. Such states can never be looked up otherwise, so they raise a
+        ValueError without encodeState.
+    :param symmetry: Optional symmetry of the Qlearner that uses the table (see Qlearner). States
+        and actions are canonicalized, if symmetric pairs were both learned, one of them wins.
+    :return: tuple (dict {S: row index}, matrix of Qs with one column per possible action)
+    Entries with an action that is not in possibleActions, e.g. the (S, None) entries that old
+    trainers wrote for the first move of a game, are dropped with a warning.
+    '''
+    actionIndex = {a: idx for idx, a in enumerate(possibleActions)}
+    index = {}
+    entries = []
+    dropped = 0
+    for (S, a), q in knownQs.items():
+        if a not in actionIndex or S is None:
+            dropped += 1
+            continue
+        if not isinstance(S, int):
+            if encodeState is None:
+                raise ValueError('Q-table with states of type {} instead of state codes, load it '
+                                 'with the game\'s encodeState or convert it with '
+                                 'convertQfile(..., encodeState=...)'.format(type(S).__name__))
+            S = encodeState(S)
+        if symmetry is not None:
+            S, t = symmetry.canonicalize(S)
+            a = symmetry.transformAction(a, t)
+        entries.append((index.setdefault(S, len(index)), actionIndex[a], q))
+    if dropped:
+        warnings.warn('Dropped {:d} of {:d} Q-table entries without a valid state and action'
+                      .format(dropped, len(knownQs)))
+    Q = np.full((len(index), len(possibleActions)), default_reward, dtype=dtype)
+    for idx, idxa, q in entries:
+        Q[idx, idxa] = q
+    return index, Q
+
+
+def convertQfile(srcfile, dstfile, possibleActions, default_reward, encodeState=None,
+                 symmetry=None):
+    '''
+    Convert a Qfile in PairQStore format to a Qfile in RowQStore format.
+    :param encodeState, symmetry: see pairs2rows()
+    :return:
+    '''
+    with open(srcfile, 'rb') as rfp:
+        knownQs = pickle.load(rfp)
+    table = pairs2rows(knownQs, possibleActions, default_reward, encodeState=encodeState,
+                       symmetry=symmetry)
+    with open(dstfile, 'wb') as wfp:
+        pickle.dump(table, wfp)
+
 
 class Qlearner:
     # TODO: Start using embedding
 
-    def __init__(self, Qfile, possibleActions, default_reward, alpha, lam):
+    # number of uniform random numbers that are drawn at once for action selection
+    NUNIFORMS = 4096
+
+    # traces below this eligibility are dropped, see updateQ()
+    MINTRACE = 1e-3
+
+    def __init__(self, Qfile, possibleActions, default_reward, alpha, lam, store=None,
+                 symmetry=None, seed=None, checkpoints=False, nsteps=1, tracedecay=0.0):
+        '''
+        :param lam: Discount factor of future rewards
+        :param store: Storage backend for the Q-values, e.g. RowQStore. Defaults to PairQStore.
+        :param symmetry: Optional object with the methods canonicalize(S), transformAction(a, t)
+            and restoreAction(a, t), typically the game. States and actions are mapped to their
+            canonical representatives before Q is looked up or updated, so symmetric boards
+            share their Q-values.
+        :param seed: Seed for the random number generator of the action selection, see seed()
+        :param checkpoints: Keep track of changed Qs for checkpoint(). Independent of this,
+            Q is always restored from Qfile plus checkpoint logs, if there are any. With
+            checkpoints, i.e. for the trainer, such logs are then merged into Qfile.
+        :param nsteps: batchlearnQ() learns from n-step returns, i.e. the next nsteps rewards of
+            the player plus the discounted max Q after them. 1 is one-step Q-learning.
+        :param tracedecay: The lambda of Q(lambda), 0 is one-step Q-learning. If > 0,
+            batchlearnQ() learns from lambda-returns instead of n-step returns, and updateQ() with
+            a trace updates all state-action pairs in the eligibility trace.
+            Traces are not cut after exploratory moves (Peng's Q(lambda)).
+        '''
         self._Qfile = Qfile
         self._possibleActions = possibleActions
         self._defaultreward = default_reward
         self._alpha = alpha
         self._lam = lam
-        # If available, init Q from file
-        if os.path.exists(self._Qfile):
-            with open(self._Qfile, 'rb') as rfp:
-                self._knownQs = pickle.load(rfp)
-        else:
-            self._knownQs = {}
+        self._nsteps = nsteps
+        self._tracedecay = tracedecay
+        self._symmetry = symmetry
+        # lookup table action -> index in possibleActions, for vectorized updates
+        self._actionIndices = np.full(max(possibleActions) + 1, -1, dtype=np.intp)
+        self._actionIndices[list(possibleActions)] = np.arange(len(possibleActions))
+        self._canonicalMasks = {}  # cache for _canonicalMask()
+        self._maskIndices = {}  # cache: legal-action mask -> indices of the legal actions
+        self.seed(seed)
+        if store is None:
+            store = PairQStore(possibleActions, default_reward)
+        self._store = store
+        # If available, init Q from file and from checkpoints that were written after it
+        if self._Qfile is not None and os.path.exists(self._Qfile):
+            self._store.load(self._Qfile)
+        if self._Qfile is not None:
+            logfiles = (self._Qfile + '.log.compacting', self._Qfile + '.log')
+            for logfile in logfiles:
+                self._replayCheckpoints(logfile)
+            if checkpoints and any(os.path.exists(logfile) for logfile in logfiles):
+                # Left over by a crash: fold the logs into Qfile before training resumes, so that
+                # the next compact() can't overwrite a log that was never merged. Only the
+                # trainer does this; other Qlearners on the same Qfile just read the logs.
+                self._writeQfile(self._store)
+                for logfile in logfiles:
+                    if os.path.exists(logfile):
+                        os.remove(logfile)
+        # (S, a) pairs that changed since the last checkpoint, None if not tracked
+        self._dirty = set() if checkpoints else None
+        self._compaction = None
+        self.instrumentation = None  # optional Instrumentation.GameInstrumentation, counts updates
+
+    def __len__(self):
+        return len(self._store)
+
+    @property
+    def possibleActions(self):
+        return self._possibleActions
+
+    def seed(self, seed=None):
+        '''
+        (Re-)seed the learner's own random number generator for action selection.
+        :param seed: If None, the seed is drawn from NumPy's global random state, so that runs
+            after np.random.seed() stay reproducible.
+        :return:
+        '''
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        self._rng = np.random.default_rng(seed)
+        self._uniforms = []
+        self._nextuniform = 0
+
+    def _uniform(self):
+        # uniform random numbers are drawn in batches, which is much cheaper than one at a time
+        if self._nextuniform == len(self._uniforms):
+            self._uniforms = self._rng.random(self.NUNIFORMS).tolist()
+            self._nextuniform = 0
+        u = self._uniforms[self._nextuniform]
+        self._nextuniform += 1
+        return u
 
     def Q(self, Sa):
-        try:
-            return self._knownQs[Sa]
-        except KeyError:
-            return self._defaultreward
+        S, a = Sa
+        if self._symmetry is not None:
+            S, t = self._symmetry.canonicalize(S)
+            a = self._symmetry.transformAction(a, t)
+        return self._store.get(S, a)
 
     def _maxQ(self, S):
-        Q = [self.Q((S, a)) for a in self._possibleActions]
-        return max(Q)
+        if self._symmetry is not None:
+            S = self._symmetry.canonicalize(S)[0]
+        return self._store.maxQ(S)
 
-    def selectAction(self, S, curiosity=None):
+    def selectAction(self, S, curiosity=None, legal=None):
         # Compute Qs of all possible actions and select the best.
         # There might be some randomness involved
-        Q = [self.Q((S, a)) for a in self._possibleActions]
+        # legal: Optional legal-action mask as sent by the game, bit idx is set if
+        # possibleActions[idx] is legal. Only legal actions are selected then.
+        if self._symmetry is not None:
+            S, t = self._symmetry.canonicalize(S)
+            if legal is not None:
+                legal = self._canonicalMask(legal, t)
+            a = self._selectAction(S, curiosity, legal)
+            return self._symmetry.restoreAction(a, t)
+        return self._selectAction(S, curiosity, legal)
+
+    def _canonicalMask(self, legal, t):
+        # legal-action mask in the canonical board, see transformAction()
+        key = (legal, t)
+        if key not in self._canonicalMasks:
+            mask = 0
+            for idx, a in enumerate(self._possibleActions):
+                if legal >> idx & 1:
+                    mask |= 1 << int(self._actionIndices[self._symmetry.transformAction(a, t)])
+            self._canonicalMasks[key] = mask
+        return self._canonicalMasks[key]
+
+    def _selectAction(self, S, curiosity, legal=None):
+        # For the handful of actions of a single state, plain Python on the list of Qs is several
+        # times faster than NumPy's per-call overhead. selectActions() is the vectorized version.
+        Q = self._store.values(S).tolist()
+        if legal is None:
+            indices = range(len(Q))
+        else:
+            indices = self._maskIndices.get(legal)
+            if indices is None:
+                indices = [idx for idx in range(len(Q)) if legal >> idx & 1]
+                self._maskIndices[legal] = indices
+            Q = [Q[idx] for idx in indices]
+        m = max(Q)
         if curiosity is None or curiosity < 0:
-            m = max(Q)
-            Praw = [1 if q == m else 0 for q in Q]
+            # greedy, ties are broken randomly
+            best = [i for i, q in enumerate(Q) if q == m]
+            i = best[int(self._uniform() * len(best))]
         else:
             # Boltzmann distribution fopr action selection
             # q = -E, positive energy-->forbidden move or defeat-->prob=0
+            # Subtracting the max Q doesn't change the distribution but avoids overflows.
             kbT = curiosity + 0.01
-            Praw = [np.exp(q/kbT) for q in Q]
-
-        sumP = sum(Praw)
-        if sumP != 0:
-            P = [p/sumP for p in Praw]
-        else:
-            P = [1/len(Praw)]*len(Praw)
-        a = np.random.choice(self._possibleActions, p=P)
-        return a
+            Praw = [math.exp((q - m) / kbT) for q in Q]
+            # inverse transform sampling
+            u = self._uniform() * sum(Praw)
+            i = len(Praw) - 1
+            for j, p in enumerate(Praw):
+                u -= p
+                if u < 0:
+                    i = j
+                    break
+        return self._possibleActions[indices[i]]
 
-    def updateQ(self, S, a, r, nextS):
-        if S is not None:
+    def updateQ(self, S, a, r, nextS, trace=None):
+        '''
+        :param trace: Optional eligibility trace of the player, a dict that the player passes
+            with every update of a game and empties after the game (see SmartAI with online=True).
+            With tracedecay > 0, the TD error of (S, a) is also applied to the earlier
+            state-action pairs of the game, weighted by (lam * tracedecay) ** (moves since then).
+        '''
+        if S is not None and trace is not None:
+            if nextS is not None:
+                target = r + self._lam * self._maxQ(nextS)
+            else:
+                target = r
+            self._updateTrace(trace, S, a, target)
+        elif S is not None:
             # Goal: update Q((S,a)) for the last move
-            Sa = (S, a)
+            if self._symmetry is not None:
+                S, t = self._symmetry.canonicalize(S)
+                a = self._symmetry.transformAction(a, t)
+                if nextS is not None:
+                    nextS = self._symmetry.canonicalize(nextS)[0]
             if nextS is not None:
-                self._knownQs[Sa] = (1 - self._alpha) * self.Q(Sa) \
-                                    + self._alpha * (r + self._lam * self._maxQ(nextS))
+                q = (1 - self._alpha) * self._store.get(S, a) \
+                    + self._alpha * (r + self._lam * self._store.maxQ(nextS))
+            else:
+                q = (1 - self._alpha) * self._store.get(S, a) + self._alpha * r
+            self._store.set(S, a, q)
+            if self._dirty is not None:
+                self._dirty.add((S, a))
+            if self.instrumentation is not None:
+                self.instrumentation.qupdates += 1
+
+    def _updateTrace(self, trace, S, a, target):
+        if self._symmetry is not None:
+            S, t = self._symmetry.canonicalize(S)
+            a = self._symmetry.transformAction(a, t)
+        delta = target - self._store.get(S, a)
+        trace[(S, a)] = 1.0  # replacing trace
+        decay = self._lam * self._tracedecay
+        for Sa, e in list(trace.items()):
+            self._store.set(Sa[0], Sa[1], self._store.get(Sa[0], Sa[1]) + self._alpha * delta * e)
+            if self._dirty is not None:
+                self._dirty.add(Sa)
+            e *= decay
+            if e < self.MINTRACE:
+                del trace[Sa]
             else:
-                self._knownQs[Sa] = (1 - self._alpha) * self.Q(Sa) + self._alpha * r
+                trace[Sa] = e
+        if self.instrumentation is not None:
+            self.instrumentation.qupdates += 1
+
+    def _updateTowards(self, S, a, target):
+        # move Q(S, a) a step alpha towards target
+        if self._symmetry is not None:
+            S, t = self._symmetry.canonicalize(S)
+            a = self._symmetry.transformAction(a, t)
+        self._store.set(S, a, (1 - self._alpha) * self._store.get(S, a) + self._alpha * target)
+        if self._dirty is not None:
+            self._dirty.add((S, a))
+        if self.instrumentation is not None:
+            self.instrumentation.qupdates += 1
+
+    def selectActions(self, states, curiosity=None, legal=None):
+        '''
+        Vectorized selectAction() for many states at once, e.g. for the boards of a BatchGame.
+        :param states: Array of states
+        :param legal: Optional boolean array with one row per state and one column per possible
+            action, e.g. as returned by BatchGame.legal(). Only legal actions are selected then.
+        :return: Array with one action per state
+        '''
+        states = np.asarray(states)
+        if self._symmetry is not None:
+            canonical = [self._symmetry.canonicalize(S) for S in states.tolist()]
+            states = [S for S, t in canonical]
+            if legal is not None:
+                # move the columns of the mask to the actions in the canonical boards
+                ts = np.array([t for S, t in canonical])
+                canonicalLegal = np.zeros_like(legal)
+                for t in np.unique(ts).tolist():
+                    rows = np.flatnonzero(ts == t)
+                    columns = self._actionIndices[[self._symmetry.transformAction(a, t)
+                                                   for a in self._possibleActions]]
+                    canonicalLegal[np.ix_(rows, columns)] = legal[rows]
+                legal = canonicalLegal
+        Q = self._store.valuesMany(states).astype(float)
+        if legal is not None:
+            Q[~legal] = -np.inf
+        if curiosity is None or curiosity < 0:
+            P = (Q == Q.max(axis=1, keepdims=True)).astype(float)
+        else:
+            # Boltzmann distribution, shifted by the max Q for numerical stability
+            kbT = curiosity + 0.01
+            P = np.exp((Q - Q.max(axis=1, keepdims=True)) / kbT)
+        # inverse transform sampling, row by row
+        cumP = np.cumsum(P, axis=1)
+        u = self._rng.random(len(cumP)) * cumP[:, -1]
+        idxa = np.minimum((cumP <= u[:, None]).sum(axis=1), cumP.shape[1] - 1)
+        actions = np.asarray(self._possibleActions)[idxa]
+        if self._symmetry is not None:
+            actions = np.array([self._symmetry.restoreAction(a, t)
+                                for a, (S, t) in zip(actions.tolist(), canonical)])
+        return actions
+
+    def updateQs(self, S, a, r, nextS, terminal=-1):
+        '''
+        Vectorized updateQ() for many experiences at once, e.g. as returned by BatchGame.step().
+        If a state-action pair occurs more than once, only one of its updates survives.
+        :param S, a, r, nextS: Arrays, one entry per experience
+        :param terminal: Value in nextS that stands for None, i.e. a terminal state
+        :return: Array of TD errors (target - Q before the update)
+        '''
+        if len(S) == 0:
+            return np.zeros(0)
+        S = np.asarray(S).tolist()
+        nextS = np.asarray(nextS)
+        r = np.asarray(r, dtype=float)
+        hasnext = nextS != terminal
+        if self._symmetry is not None:
+            canonical = [self._symmetry.canonicalize(s) for s in S]
+            S = [s for s, t in canonical]
+            a = [self._symmetry.transformAction(x, t) for x, (s, t) in zip(np.asarray(a).tolist(),
+                                                                           canonical)]
+            nextS = np.array([self._symmetry.canonicalize(s)[0] if h else terminal
+                              for s, h in zip(nextS.tolist(), hasnext)])
+        idxa = self._actionIndices[np.asarray(a)]
+        q = self._store.valuesMany(S)[np.arange(len(S)), idxa].astype(float)
+        target = r.copy()
+        if hasnext.any():
+            nextQ = self._store.valuesMany(nextS[hasnext].tolist())
+            target[hasnext] += self._lam * nextQ.max(axis=1)
+        self._store.setMany(S, idxa, (1 - self._alpha) * q + self._alpha * target)
+        if self._dirty is not None:
+            self._dirty.update(zip(S, np.asarray(self._possibleActions)[idxa].tolist()))
+        if self.instrumentation is not None:
+            self.instrumentation.qupdates += len(S)
+        return target - q
+
+    def learnFromReplay(self, replay, batchsize, prioritized=False):
+        '''
+        Sample a minibatch from an Experience.ReplayBuffer and learn from it with updateQs().
+        For prioritized replay, the priorities of the sampled experiences are updated with their
+        new TD errors.
+        :return:
+        '''
+        if len(replay) == 0:
+            return
+        idx, S, a, r, nextS = replay.sample(batchsize, prioritized)
+        tderrors = self.updateQs(S, a, r, nextS, terminal=NONE)
+        if prioritized:
+            replay.updatePriorities(idx, tderrors)
 
     def batchlearnQ(self, games, repeat, backprop=False):
         # Goal: update Q((S, a)) for all experiences (S, a, r, nextS)
@@ -66,6 +840,9 @@ class Qlearner:
         while cnt < repeat:
             cnt += 1
             for game in games:
+                if self._tracedecay > 0 or self._nsteps > 1:
+                    self._learnReturns(game, backprop)
+                    continue
                 Nx = len(game)
                 if backprop:
                     learning_order = range(Nx - 1, -1, -1)
@@ -79,7 +856,126 @@ class Qlearner:
                     nextS = experience[3]
                     self.updateQ(S, a, r, nextS)
 
+    @staticmethod
+    def _successors(game):
+        '''
+        :param game: List of experiences (S, a, r, nextS) of one player
+        :return: List with the index of the experience that continues from nextS, for each
+            experience; None at the end of the game and after invalid moves
+        '''
+        # invalid moves are dead ends (nextS is None) in the middle of the game; the next move
+        # from their state is the successor of the move before
+        valid = [j for j in range(len(game)) if game[j][3] is not None or j == len(game) - 1]
+        successors = [None] * len(game)
+        for k, i in enumerate(valid):
+            nextS = game[i][3]
+            if nextS is not None and k + 1 < len(valid) and game[valid[k + 1]][0] == nextS:
+                successors[i] = valid[k + 1]
+        return successors
+
+    def _learnReturns(self, game, backprop):
+        '''
+        batchlearnQ() for one game with n-step or lambda-returns as targets.
+        Targets are computed from the end of the game backwards, from Q after the updates of the
+        later moves if backprop is True.
+        '''
+        successors = self._successors(game)
+        targets = [None] * len(game)
+        for i in range(len(game) - 1, -1, -1):
+            S, a, r, nextS = game[i]
+            if nextS is None:
+                target = r
+            elif self._tracedecay > 0:
+                # lambda-return: G_i = r_i + lam * ((1 - decay) * maxQ(S_i+1) + decay * G_i+1)
+                target = self._maxQ(nextS)
+                if successors[i] is not None:
+                    target = (1 - self._tracedecay) * target \
+                        + self._tracedecay * targets[successors[i]]
+                target = r + self._lam * target
+            else:
+                # n-step return: rewards of up to nsteps moves, then the max Q of the next state
+                target = 0.0
+                discount = 1.0
+                j = i
+                for n in range(0, self._nsteps):
+                    Sj, aj, rj, nextSj = game[j]
+                    target += discount * rj
+                    discount *= self._lam
+                    if nextSj is None:
+                        break
+                    if n == self._nsteps - 1 or successors[j] is None:
+                        target += discount * self._maxQ(nextSj)
+                        break
+                    j = successors[j]
+            targets[i] = target
+            if backprop:
+                self._updateTowards(S, a, target)
+        if not backprop:
+            for (S, a, r, nextS), target in zip(game, targets):
+                self._updateTowards(S, a, target)
+
     def saveQ(self):
-        # Store updated Q
-        with open(self._Qfile, 'wb') as wfp:
-            pickle.dump(self._knownQs, wfp)
+        # Store updated Q; this makes all checkpoints obsolete
+        self._waitForCompaction()
+        self._writeQfile(self._store)
+        for logfile in (self._Qfile + '.log', self._Qfile + '.log.compacting'):
+            if os.path.exists(logfile):
+                os.remove(logfile)
+        if self._dirty is not None:
+            self._dirty.clear()
+
+    def checkpoint(self):
+        '''
+        Append all Qs that changed since the last checkpoint to the checkpoint log (Qfile + '.log').
+        This is cheap compared to saveQ() because it only writes the changes.
+        Requires Qlearner(..., checkpoints=True).
+        :return:
+        '''
+        if self._dirty is None:
+            raise ValueError('Checkpoints are not enabled for this Qlearner')
+        changes = [(S, a, self._store.get(S, a)) for S, a in self._dirty]
+        with open(self._Qfile + '.log', 'ab') as f:
+            pickle.dump(changes, f)
+            f.flush()
+            os.fsync(f.fileno())
+        self._dirty.clear()
+
+    def compact(self):
+        '''
+        Write a checkpoint, then merge Qfile and the checkpoint log into a new Qfile in a
+        background thread. Training can go on meanwhile; new checkpoints go to a new log.
+        At any time, Qfile plus the logs that exist on disk contain the complete Q.
+        :return:
+        '''
+        self._waitForCompaction()
+        self.checkpoint()
+        # From here on, Qfile + '.log.compacting' is covered by the snapshot
+        os.replace(self._Qfile + '.log', self._Qfile + '.log.compacting')
+        snapshot = copy.deepcopy(self._store)
+        self._compaction = threading.Thread(target=self._writeSnapshot, args=(snapshot,))
+        self._compaction.start()
+
+    def _writeSnapshot(self, snapshot):
+        self._writeQfile(snapshot)
+        os.remove(self._Qfile + '.log.compacting')
+
+    def _writeQfile(self, store):
+        _writeAtomically(self._Qfile, store.save)
+
+    def _waitForCompaction(self):
+        if self._compaction is not None:
+            self._compaction.join()
+            self._compaction = None
+
+    def _replayCheckpoints(self, logfile):
+        if not os.path.exists(logfile):
+            return
+        with open(logfile, 'rb') as f:
+            while 1:
+                try:
+                    changes = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    # end of log, or a checkpoint that was cut off by a crash
+                    break
+                for S, a, q in changes:
+                    self._store.set(S, a, q)
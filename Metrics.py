@@ -0,0 +1,155 @@
+import os
+import csv
+import json
+import time
+import numpy as np
+
+# game status as in Games: 0 and 1 are wins of player 0 and 1, 2 is a draw
+STATUSES = ('win0', 'win1', 'draw')
+
+
+class MetricsSink:
+    '''
+    Training metrics in O(1) memory, instead of a list with the status of every game.
+    For every game, add() updates
+        - the win/draw rates over the last "window" games (counts plus a ring buffer of statuses)
+        - exponentially weighted win/draw rates, rate = alpha * rate + (1 - alpha) * outcome,
+          bias-corrected for the first games
+    Every "every" games, a row with these rates, the mean moves/game and games/sec since the last
+    row and the number of Q entries is written to metricsFile: as CSV if the name ends with
+    ".csv", else as JSON lines. See loadMetrics() and plotMetrics() for reading it.
+    '''
+
+    FIELDS = ('games', 'sec', 'games/sec', 'moves/game', 'Q entries') \
+        + tuple('rolling ' + s for s in STATUSES) + tuple('exp ' + s for s in STATUSES)
+
+    def __init__(self, metricsFile=None, every=1000, window=1000, alpha=0.999, ql=None,
+                 append=False, verbose=True):
+        '''
+        :param metricsFile: File for the rows, None to only keep the latest row in memory
+        :param ql: Optional Qlearner whose size is recorded
+        :param append: Append to an existing metricsFile instead of overwriting it
+        :param verbose: Also print a progress line for every row
+        '''
+        self._metricsFile = metricsFile
+        self._csv = metricsFile is not None and metricsFile.endswith('.csv')
+        self._every = every
+        self._window = [-1] * window  # ring buffer of the statuses of the last games
+        self._counts = [0, 0, 0]
+        self._alpha = alpha
+        self._exp = [0.0, 0.0, 0.0]
+        self._ql = ql
+        self._verbose = verbose
+        self.games = 0
+        self.row = None
+        self._t0 = time.perf_counter()
+        self._tlast = self._t0
+        self._gameslast = 0
+        self._moves = 0
+        if metricsFile is not None and not append and os.path.exists(metricsFile):
+            os.remove(metricsFile)
+
+    def add(self, status, moves=0):
+        '''
+        :param status: Final game status, i.e. the winner or DRAW
+        :param moves: Number of moves of the game
+        '''
+        idx = self.games % len(self._window)
+        old = self._window[idx]
+        if old >= 0:
+            self._counts[old] -= 1
+        self._window[idx] = status
+        self._counts[status] += 1
+        alpha = self._alpha
+        for s in (0, 1, 2):
+            self._exp[s] = alpha * self._exp[s] + (1 - alpha) * (s == status)
+        self._moves += moves
+        self.games += 1
+        if self.games % self._every == 0:
+            self.flush()
+
+    def rates(self):
+        '''
+        :return: Tuple (rolling rates, exponential rates), each a list [win0, win1, draw]
+        '''
+        n = min(self.games, len(self._window))
+        rolling = [c / n if n else 0.0 for c in self._counts]
+        correction = 1 - self._alpha ** self.games
+        exponential = [e / correction if correction > 0 else 0.0 for e in self._exp]
+        return rolling, exponential
+
+    def flush(self):
+        # write a row for the games since the last row
+        t = time.perf_counter()
+        games = self.games - self._gameslast
+        if games == 0:
+            return
+        rolling, exponential = self.rates()
+        values = [self.games, t - self._t0, games / (t - self._tlast), self._moves / games,
+                  len(self._ql) if self._ql is not None else 0] + rolling + exponential
+        self.row = dict(zip(self.FIELDS, values))
+        self._tlast = t
+        self._gameslast = self.games
+        self._moves = 0
+
+        if self._metricsFile is not None:
+            new = not os.path.exists(self._metricsFile) or os.path.getsize(self._metricsFile) == 0
+            with open(self._metricsFile, 'a', newline='') as f:
+                if self._csv:
+                    writer = csv.writer(f)
+                    if new:
+                        writer.writerow(self.FIELDS)
+                    writer.writerow(values)
+                else:
+                    f.write(json.dumps(self.row) + '\n')
+        if self._verbose:
+            print('{:d} games, {:.0f} games/sec, {:.1f} moves/game, {:d} Q entries, '
+                  'win0/win1/draw {:.3f}/{:.3f}/{:.3f}'.format(
+                      self.games, self.row['games/sec'], self.row['moves/game'],
+                      self.row['Q entries'], *rolling))
+
+    def close(self):
+        self.flush()
+
+
+def loadMetrics(metricsFile):
+    '''
+    :return: Dict field -> NumPy array with one entry per row
+    '''
+    if metricsFile.endswith('.csv'):
+        with open(metricsFile, newline='') as f:
+            rows = list(csv.reader(f))
+        data = np.array(rows[1:], dtype=float).reshape(-1, len(rows[0]))
+        return {field: data[:, idx] for idx, field in enumerate(rows[0])}
+    with open(metricsFile) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return {field: np.array([row[field] for row in rows], dtype=float) for field in rows[0]}
+
+
+def boxedRates(statuses, K=1000):
+    '''
+    Win/draw rates over consecutive blocks of K games, e.g. for the list of statuses that
+    ParallelTrainer.train() returns.
+    :return: Array with one row per complete block and the columns win0, win1, draw
+    '''
+    statuses = np.asarray(statuses, dtype=np.int64)
+    nblocks = len(statuses) // K
+    blocks = statuses[:nblocks * K].reshape(nblocks, K)
+    return np.stack([(blocks == s).mean(axis=1) for s in (0, 1, 2)], axis=1)
+
+
+def plotMetrics(metricsFile):
+    # imported here, so that training also works on hosts without matplotlib
+    import matplotlib.pyplot as plt
+
+    data = loadMetrics(metricsFile)
+    fig, (ax0, ax1) = plt.subplots(2, 1, sharex=True)
+    for s in STATUSES:
+        ax0.plot(data['games'], data['rolling ' + s], label=s)
+        ax0.plot(data['games'], data['exp ' + s], ':', label=s + ' (exp)')
+    ax0.legend()
+    ax1.plot(data['games'], data['games/sec'], label='games/sec')
+    ax1.plot(data['games'], data['moves/game'] * 100, label='moves/game x 100')
+    ax1.set_xlabel('games')
+    ax1.legend()
+    plt.show()
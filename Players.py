@@ -1,5 +1,6 @@
 import random
-import pickle
+
+from Experience import appendGame
 
 
 class HumanPlayerInterface:
@@ -62,7 +63,7 @@ class HumanPlayerInterface:
     def sendReward(self, reward, resultingState):
         pass
 
-    def setState(self, state):
+    def setState(self, state, legal=None):
         self._boardstate = state
         self._visualizer.visualizeState(self._boardstate)
 
@@ -75,11 +76,18 @@ class HumanPlayerInterface:
 
 class DumbAI:
 
-    def __init__(self, somename, experienceFile=None):
+    def __init__(self, somename, experienceFile, possibleActions):
+        '''
+        :param experienceFile: File the games are appended to, or None
+        :param possibleActions: The game's POSSIBLE_ACTIONS
+        '''
         self._name = somename
         self._experienceFile = experienceFile
+        self._possibleActions = possibleActions
+        self._legalActions = {}  # cache: legal-action mask -> list of legal actions
         self._game = []  # TODO: Rename to trajectory or something similar
         self._boardstate = None
+        self._legal = None
         self._actionstate = None  # TODO: Check if "_actionstate" can be removed"
         self._action = None
         self._watchesState = False
@@ -97,21 +105,29 @@ class DumbAI:
     def readsMessages(self):
         return self._readsMessages
 
-    def setState(self, state):
+    def setState(self, state, legal=None):
+        '''
+        :param legal: Legal-action mask as returned by the game's legalActions(), i.e. bit idx is
+            set if possibleActions[idx] is a legal move, or None if every action may be tried
+        '''
         self._boardstate = state
+        self._legal = legal
 
     def turn(self):
         # remember in which state the board was when action was chosen
         self._actionstate = self._boardstate
         # select action, store, and return
-        self._action = self.chooseAction(None)
+        self._action = self.chooseAction(self._legal)
         return self._action
 
-    # TODO: remove hard-coded range of possible moves: this is not game-agnostic
-    def chooseAction(self, forbiddenmoves=None):
+    def chooseAction(self, legal=None):
         # chooseAction() does NOT store the action? It could also be purely hypothetical action
-        # "forbiddenmoves" is currently an unused feature
-        return random.randint(1, 9)
+        if legal is None:
+            return random.choice(self._possibleActions)
+        if legal not in self._legalActions:
+            self._legalActions[legal] = \
+                [a for idx, a in enumerate(self._possibleActions) if legal >> idx & 1]
+        return random.choice(self._legalActions[legal])
 
     def sendReward(self, reward, resultingState):
         experience = (self._actionstate, self._action, reward, resultingState)
@@ -119,35 +135,73 @@ class DumbAI:
 
     def finalize(self):
         if self._experienceFile is not None:
-            # store game's history for future use (e.g. batch learning)
-            with open(self._experienceFile, 'ab') as f:
-                    pickle.dump(self._game, f)
+            # store game's history for future use (e.g. batch learning), see Experience.py
+            appendGame(self._experienceFile, self._game)
         # reset
         self._game = []
         self._boardstate = None
+        self._legal = None
         self._action = None
 
 
 class SmartAI(DumbAI):
 
-    def __init__(self, somename, experienceFile, ql, curiosity=1.0):
-        DumbAI.__init__(self, somename, experienceFile)
+    def __init__(self, somename, experienceFile, ql, curiosity=1.0, replay=None, replayBatch=32,
+                 prioritized=False, online=False):
+        '''
+        :param replay: Optional Experience.ReplayBuffer. If given, every finished game is added to
+            it and a minibatch of replayBatch experiences is replayed in addition to the game.
+        :param prioritized: Sample from the replay buffer by TD error instead of uniformly
+        :param online: Learn from every experience as soon as it arrives, with the player's own
+            eligibility trace (see Qlearner.updateQ()), instead of from the whole game in
+            finalize()
+        '''
+        DumbAI.__init__(self, somename, experienceFile, ql.possibleActions)
         self._ql = ql
         self._curiosity = curiosity
+        self._replay = replay
+        self._replayBatch = replayBatch
+        self._prioritized = prioritized
+        self._online = online
+        self._trace = {}
+        # online: the last experience if it had no resulting state, see sendReward()
+        self._deadend = None
+
+    def turn(self):
+        if self._deadend is not None:
+            # the game goes on, so the last move was invalid: a dead end, which is learned from
+            # at once but kept out of the eligibility trace, like in Qlearner._successors()
+            self._ql.updateQ(*self._deadend)
+            self._deadend = None
+        return super(SmartAI, self).turn()
 
-    def chooseAction(self, forbiddenmoves=None):
-        # forbiddenmoves is currently unused
-        return self._ql.selectAction(self._actionstate, self._curiosity)
+    def chooseAction(self, legal=None):
+        return self._ql.selectAction(self._actionstate, self._curiosity, legal)
 
     def sendReward(self, reward, resultingState):
         super(SmartAI, self).sendReward(reward, resultingState)
+        if self._online and resultingState is None:
+            # an invalid move or the end of the game; which one shows in turn() or finalize()
+            self._deadend = (self._actionstate, self._action, reward, None)
+        elif self._online:
+            self._ql.updateQ(self._actionstate, self._action, reward, resultingState, self._trace)
         # In order to avoid endless loops, I need to have this update here
-        if resultingState is None:
+        elif resultingState is None:
             self._ql.updateQ(self._actionstate, self._action, reward, resultingState)
 
     def finalize(self):
-        self._ql.batchlearnQ([self._game], 1, backprop=True)
+        if not self._online:
+            self._ql.batchlearnQ([self._game], 1, backprop=True)
+        elif self._deadend is not None:
+            # the end of the game
+            self._ql.updateQ(*self._deadend, trace=self._trace)
+            self._deadend = None
+        self._trace = {}
+        if self._replay is not None:
+            self._replay.addGame(self._game)
+            self._ql.learnFromReplay(self._replay, self._replayBatch, self._prioritized)
         # reset
         self._game = []
         self._boardstate = None
+        self._legal = None
         self._action = None
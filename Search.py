@@ -0,0 +1,656 @@
+import math
+import time
+import random
+import threading
+import numpy as np
+
+from Games import TicTacToe, VierGewinnt
+from Players import DumbAI
+
+
+class _Timeout(Exception):
+    pass
+
+
+class _Rules:
+    '''
+    The rules of TicTacToe and VierGewinnt on bitboards, for searching many positions fast.
+    Positions are kept as two bitboards, one for the player to move and one for the opponent
+    (TicTacToe: bit idx for field idx + 1, VierGewinnt: the bitboard layout of VierGewinnt). A move
+    only has to be checked against the winning lines through its field.
+    '''
+
+    def __init__(self, game):
+        '''
+        :param game: TicTacToe or VierGewinnt instance, it is only used for the rules and size
+        '''
+        self.game = game
+        self.possibleActions = game.POSSIBLE_ACTIONS
+        # self.lines[bit]: masks of the winning lines through a field
+        # self.deltas[player][bit]: change of the state code when player puts a stone on bit
+        if isinstance(game, TicTacToe):
+            self.ncells = 9
+            self.order = (5, 1, 3, 7, 9, 2, 4, 6, 8)
+            self.movebit = self._movebitTicTacToe
+            self.lines = {1 << idx: tuple(sum(1 << field for field in line)
+                                          for line in game.winners if idx in line)
+                          for idx in range(0, 9)}
+            self.deltas = tuple({1 << idx: (player - TicTacToe.UNMARKED) * TicTacToe._POW3[idx]
+                                 for idx in range(0, 9)} for player in (0, 1))
+        elif isinstance(game, VierGewinnt):
+            nrows, ncols = game.NROWS, game.NCOLS
+            h1 = nrows + 1
+            self.ncells = nrows * ncols
+            self.order = tuple(sorted(game.POSSIBLE_ACTIONS, key=lambda a: abs(2 * a - ncols - 1)))
+            self.movebit = self._movebitVierGewinnt
+            self._bottom = {a: 1 << ((a - 1) * h1) for a in game.POSSIBLE_ACTIONS}
+            self._top = {a: 1 << ((a - 1) * h1 + nrows - 1) for a in game.POSSIBLE_ACTIONS}
+            self._colmask = {a: ((1 << nrows) - 1) << ((a - 1) * h1) for a in game.POSSIBLE_ACTIONS}
+
+            def bit(field):
+                idxrow, idxcol = divmod(field, ncols)
+                return 1 << (idxcol * h1 + idxrow)
+            self.lines = {bit(field): tuple(sum(bit(f) for f in game._winninglines[idxline])
+                                            for idxline in idxlines)
+                          for field, idxlines in enumerate(game._celllines)}
+            self.deltas = tuple({b: (1 + player) * b for b in self.lines} for player in (0, 1))
+        else:
+            raise TypeError('Search supports TicTacToe and VierGewinnt, not {}'
+                            .format(type(game).__name__))
+
+    def _movebitTicTacToe(self, a, occupied):
+        # :return: The bit of the field of move a, 0 if the move is illegal
+        bit = 1 << (a - 1)
+        return 0 if occupied & bit else bit
+
+    def _movebitVierGewinnt(self, a, occupied):
+        if occupied & self._top[a]:
+            return 0
+        # the lowest free field of the column
+        return (occupied + self._bottom[a]) & self._colmask[a]
+
+    def wins(self, mine, bit):
+        for line in self.lines[bit]:
+            if mine & line == line:
+                return True
+        return False
+
+    def position(self, S):
+        '''
+        :param S: State code as sent by the game
+        :return: Tuple (bitboard of the player to move, bitboard of the opponent, number of stones)
+        '''
+        bbs = [0, 0]
+        if isinstance(self.game, TicTacToe):
+            for idx, marker in enumerate(TicTacToe.decodeState(S)):
+                if marker != TicTacToe.UNMARKED:
+                    bbs[marker] |= 1 << idx
+        else:
+            nrows, ncols = self.game.NROWS, self.game.NCOLS
+            state = VierGewinnt.decodeState(S, nrows, ncols)
+            for idxrow in range(0, nrows):
+                for idxcol in range(0, ncols):
+                    if state[idxrow][idxcol] != VierGewinnt.UNMARKED:
+                        bbs[state[idxrow][idxcol]] |= 1 << (idxcol * (nrows + 1) + idxrow)
+        nstones = bin(bbs[0]).count('1') + bin(bbs[1]).count('1')
+        # player 0 always starts
+        player = nstones % 2
+        return bbs[player], bbs[1 - player], nstones
+
+    def isTerminal(self, S):
+        '''
+        :return: True if somebody has won or the board is full
+        '''
+        me, other, nstones = self.position(S)
+        for bb in (me, other):
+            for lines in self.lines.values():
+                for line in lines:
+                    if bb & line == line:
+                        return True
+        return nstones == self.ncells
+
+
+class Solver:
+    '''
+    Negamax search with alpha-beta pruning for TicTacToe and VierGewinnt, see _Rules.
+
+    Values are from the point of view of the player to move: a win scores 1 + the number of empty
+    fields after the winning move, so faster wins score higher, a loss scores the negative of that
+    and a draw 0. With a limited depth, positions at the horizon score 0, so a value != 0 is a
+    proven win or loss.
+
+    Moves are ordered by the best move found before for the same position, then center first.
+    Results are kept in a transposition table with 2 ** ttbits entries, indexed by a hash of the
+    state code; a new entry always replaces the old one with the same index.
+    '''
+
+    EXACT = 0
+    LOWER = 1
+    UPPER = 2
+
+    # the clock is checked every CHECKEVERY nodes
+    CHECKEVERY = 1024
+
+    clock = time.perf_counter
+
+    def __init__(self, game, ttbits=20):
+        '''
+        :param game: TicTacToe or VierGewinnt instance, it is only used for the rules and size
+        :param ttbits: log2 of the number of entries of the transposition table
+        '''
+        rules = _Rules(game)
+        self._rules = rules
+        self._possibleActions = rules.possibleActions
+        self._ncells = rules.ncells
+        self._order = rules.order
+        self._movebit = rules.movebit
+        self._wins = rules.wins
+        self._deltas = rules.deltas
+        self.position = rules.position
+        self.isTerminal = rules.isTerminal
+
+        self._ttbits = ttbits
+        self._ttkeys = [None] * (1 << ttbits)
+        self._ttentries = [None] * (1 << ttbits)
+        self._deadline = None
+        self.nodes = 0
+
+    def _ttindex(self, key):
+        # Fibonacci hashing of the state code
+        return ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - self._ttbits)
+
+    def _negamax(self, me, other, code, nstones, depth, alpha, beta):
+        # value of a non-terminal position for the player to move, see class docstring
+        self.nodes += 1
+        if self._deadline is not None and self.nodes % self.CHECKEVERY == 0 \
+                and self.clock() > self._deadline:
+            raise _Timeout()
+        occupied = me | other
+        free = self._ncells - nstones
+
+        # winning moves end the search, other legal moves are searched below
+        moves = []
+        for a in self._order:
+            bit = self._movebit(a, occupied)
+            if bit:
+                if self._wins(me | bit, bit):
+                    return free
+                moves.append((a, bit))
+        if free == 1 or depth <= 1:
+            return 0
+        # we can not win before our next move
+        beta = min(beta, free - 2)
+        if alpha >= beta:
+            return beta
+
+        depth = min(depth, free)
+        idx = self._ttindex(code)
+        if self._ttkeys[idx] == code:
+            value, flag, entrydepth, best = self._ttentries[idx]
+            if entrydepth >= depth:
+                if flag == Solver.EXACT:
+                    return value
+                elif flag == Solver.LOWER:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+            moves.sort(key=lambda move: move[0] != best)
+
+        alpha0 = alpha
+        bestvalue = -self._ncells - 1
+        bestaction = None
+        deltas = self._deltas[nstones & 1]
+        for a, bit in moves:
+            value = -self._negamax(other, me | bit, code + deltas[bit], nstones + 1, depth - 1,
+                                   -beta, -alpha)
+            if value > bestvalue:
+                bestvalue = value
+                bestaction = a
+                if value > alpha:
+                    alpha = value
+                    if alpha >= beta:
+                        break
+
+        if bestvalue <= alpha0:
+            flag = Solver.UPPER
+        elif bestvalue >= beta:
+            flag = Solver.LOWER
+        else:
+            flag = Solver.EXACT
+        self._ttkeys[idx] = code
+        self._ttentries[idx] = (bestvalue, flag, depth, bestaction)
+        return bestvalue
+
+    def _actionValues(self, me, other, code, nstones, depth, actions):
+        # :return: List of values of the given actions for the player to move, None if illegal
+        occupied = me | other
+        free = self._ncells - nstones
+        deltas = self._deltas[nstones & 1]
+        values = []
+        for a in actions:
+            bit = self._movebit(a, occupied)
+            if not bit:
+                values.append(None)
+            elif self._wins(me | bit, bit):
+                values.append(free)
+            elif free == 1:
+                values.append(0)
+            else:
+                values.append(-self._negamax(other, me | bit, code + deltas[bit], nstones + 1,
+                                             depth - 1, -self._ncells - 1, self._ncells + 1))
+        return values
+
+    def search(self, S, budget=None, maxdepth=None):
+        '''
+        Iterative deepening: search S with depth 1, 2, ... until the value is exact or the time
+        budget is used up. Depth 1, i.e. finding winning moves, is always completed.
+        :param S: State code of a non-terminal state
+        :param budget: Time budget in seconds, None for no limit
+        :param maxdepth: Maximum depth in moves, None for no limit
+        :return: Tuple (best action, value, depth, exact) of the deepest completed search
+        '''
+        me, other, nstones = self.position(S)
+        free = self._ncells - nstones
+        if maxdepth is None:
+            maxdepth = free
+        result = None
+        best = None
+        order = self._order
+        try:
+            for depth in range(1, maxdepth + 1):
+                # the best action of the last iteration is searched first
+                actions = sorted(order, key=lambda a: a != best)
+                values = self._actionValues(me, other, S, nstones, depth, actions)
+                value = max(v for v in values if v is not None)
+                best = actions[values.index(value)]
+                exact = depth >= free or value != 0
+                result = (best, value, depth, exact)
+                if exact:
+                    break
+                if budget is not None and self._deadline is None:
+                    self._deadline = self.clock() + budget
+        except _Timeout:
+            pass
+        finally:
+            self._deadline = None
+        return result
+
+    def actionValues(self, S, budget=None):
+        '''
+        Exact values of all possible actions in S, see class docstring.
+        :param budget: Time budget in seconds, None for no limit
+        :return: List with one value per action in POSSIBLE_ACTIONS, None for illegal actions;
+            None instead of a list if the budget was used up
+        '''
+        me, other, nstones = self.position(S)
+        if budget is not None:
+            self._deadline = self.clock() + budget
+        try:
+            return self._actionValues(me, other, S, nstones, self._ncells, self._possibleActions)
+        except _Timeout:
+            return None
+        finally:
+            self._deadline = None
+
+    def labelStates(self, states, budget=None):
+        '''
+        Label states with their exact outcome for the player to move.
+        :param states: Iterable of state codes
+        :param budget: Time budget in seconds per state, None for no limit
+        :return: Tuple (outcome, actionOutcomes) of float arrays. outcome[i] is 1 for a win, 0 for a
+            draw and -1 for a loss, actionOutcomes[i, idx] is the outcome after possibleActions[idx].
+            Both are NaN for illegal actions, terminal states, and states that could not be
+            solved within the budget.
+        '''
+        states = list(states)
+        actionOutcomes = np.full((len(states), len(self._possibleActions)), np.nan)
+        for i, S in enumerate(states):
+            if self.isTerminal(S):
+                continue
+            values = self.actionValues(S, budget)
+            if values is not None:
+                actionOutcomes[i] = [np.nan if v is None else np.sign(v) for v in values]
+        outcome = np.full(len(states), np.nan)
+        solved = ~np.isnan(actionOutcomes).all(axis=1)
+        outcome[solved] = np.nanmax(actionOutcomes[solved], axis=1)
+        return outcome, actionOutcomes
+
+    def labelQlearner(self, ql, budget=None):
+        '''
+        Label all states in a Qlearner's table, e.g. to measure how often its greedy action is an
+        optimal one.
+        :param ql: Qlearner for the same game
+        :param budget: Time budget in seconds per state, None for no limit
+        :return: Tuple (states, outcome, actionOutcomes), see labelStates()
+        '''
+        states = np.array(list(ql._store.states()), dtype=np.int64)
+        outcome, actionOutcomes = self.labelStates(states.tolist(), budget)
+        return states, outcome, actionOutcomes
+
+
+class SearchAI(DumbAI):
+    '''
+    Player that selects its moves with a Solver, e.g. as a strong reference opponent.
+    '''
+
+    def __init__(self, somename, game, budget=1.0, experienceFile=None, ttbits=20):
+        '''
+        :param game: The game that is played; the player keeps its own copy of the rules
+        :param budget: Time budget in seconds per move, None to always search until the exact
+            value is known
+        '''
+        DumbAI.__init__(self, somename, experienceFile, game.POSSIBLE_ACTIONS)
+        self._solver = Solver(game, ttbits)
+        self._budget = budget
+
+    @property
+    def solver(self):
+        return self._solver
+
+    def chooseAction(self, legal=None):
+        return self._solver.search(self._actionstate, self._budget)[0]
+
+
+class _Node:
+    # Node of the MCTS tree. W is the sum of the results from the point of view of the player
+    # who made the move into the node.
+    __slots__ = ('me', 'other', 'code', 'nstones', 'terminal', 'moves', 'priors', 'children',
+                 'N', 'W')
+
+    def __init__(self, me, other, code, nstones, terminal=None):
+        self.me = me
+        self.other = other
+        self.code = code
+        self.nstones = nstones
+        self.terminal = terminal  # None, or the result for the player to move if terminal
+        self.moves = None  # legal moves (action, bit), set on expansion
+        self.priors = None
+        self.children = {}
+        self.N = 0
+        self.W = 0.0
+
+
+class MCTS:
+    '''
+    Monte Carlo Tree Search for TicTacToe and VierGewinnt, see _Rules.
+
+    Every iteration walks down the tree, expands one new node and plays a random game ("rollout")
+    from it. Without a prior, children are selected by UCT, unvisited children first. With a
+    Qlearner as prior, children are selected by PUCT, where the prior probabilities are the
+    Boltzmann distribution of the Q-values that Qlearner.selectAction() uses.
+    Rollouts make a winning move if there is one, and otherwise a random legal move, or the move
+    that the Qlearner selects.
+
+    The tree is kept between moves: advance() makes the node of the new state the root, so the
+    statistics of the moves that were actually played are reused.
+    '''
+
+    clock = time.perf_counter
+
+    def __init__(self, game, exploration=1.4, ql=None, prior=True, rollouts=False, curiosity=0.1,
+                 seed=None):
+        '''
+        :param game: TicTacToe or VierGewinnt instance, it is only used for the rules and size
+        :param exploration: Exploration constant of UCT/PUCT
+        :param ql: Optional Qlearner for the same game
+        :param prior: Use ql as prior for the selection
+        :param rollouts: Use ql.selectAction() with curiosity as rollout policy
+        :param seed: Seed for the random rollouts
+        '''
+        self._rules = _Rules(game)
+        self._exploration = exploration
+        self._ql = ql
+        self._prior = ql is not None and prior
+        self._qlrollouts = ql is not None and rollouts
+        self._curiosity = curiosity
+        self._random = random.Random(seed)
+        self._root = None
+        self.iterations = 0
+
+    @property
+    def root(self):
+        return self._root
+
+    def advance(self, S):
+        '''
+        Make the node of state S the new root, reuse it if it is a child or grandchild of the old
+        root, i.e. after one or two moves.
+        '''
+        root = self._root
+        if root is not None and root.code != S:
+            candidates = list(root.children.values())
+            candidates += [grandchild for child in candidates
+                           for grandchild in child.children.values()]
+            root = next((node for node in candidates if node.code == S), None)
+        if root is None:
+            me, other, nstones = self._rules.position(S)
+            root = _Node(me, other, S, nstones)
+        self._root = root
+        return root
+
+    def reset(self):
+        self._root = None
+
+    def search(self, S, budget, visits=None):
+        '''
+        Search until the time budget is used up, but at least until the root has an expanded
+        child (two iterations on a fresh root), so that there always is an action to return.
+        :param S: State code of a non-terminal state
+        :param budget: Time budget in milliseconds
+        :param visits: Stop as soon as the root has this many visits, possibly without any
+            iteration if the tree was searched before (see MCTSAI with ponder=True)
+        :return: The most visited action
+        '''
+        root = self.advance(S)
+        deadline = self.clock() + budget / 1000.0
+        while True:
+            if visits is not None and root.N >= visits and root.children:
+                break
+            self.iterate()
+            if self.clock() > deadline and root.children:
+                break
+        return self.bestAction()
+
+    def bestAction(self):
+        root = self._root
+        return max(root.children, key=lambda a: root.children[a].N)
+
+    def choose(self, action):
+        # continue with the subtree of an action of the root, e.g. the one that was played
+        self._root = self._root.children.get(action)
+
+    def iterate(self):
+        '''
+        One iteration: selection, expansion, rollout and backpropagation.
+        '''
+        node = self._root
+        path = [node]
+        while node.terminal is None and node.moves is not None:
+            action = self._select(node)
+            child = node.children.get(action)
+            if child is None:
+                node = self._expand(node, action)
+                path.append(node)
+                break
+            node = child
+            path.append(node)
+        if node.terminal is not None:
+            result = node.terminal
+        else:
+            if node.moves is None:
+                self._initMoves(node)
+            result = self._rollout(node)
+        # result is for the player to move in node; W counts for the player who moved into it
+        for node in reversed(path):
+            node.N += 1
+            node.W -= result
+            result = -result
+        self.iterations += 1
+
+    def _initMoves(self, node):
+        occupied = node.me | node.other
+        movebit = self._rules.movebit
+        node.moves = [(a, movebit(a, occupied)) for a in self._rules.order
+                      if movebit(a, occupied)]
+        if self._prior:
+            kbT = self._curiosity + 0.01
+            Q = [self._ql.Q((node.code, a)) for a, bit in node.moves]
+            m = max(Q)
+            P = [math.exp((q - m) / kbT) for q in Q]
+            total = sum(P)
+            node.priors = [p / total for p in P]
+
+    def _select(self, node):
+        c = self._exploration
+        children = node.children
+        if node.priors is None:
+            # UCT, unvisited children first
+            if len(children) < len(node.moves):
+                for a, bit in node.moves:
+                    if a not in children:
+                        return a
+            logN = math.log(node.N)
+            return max(children, key=lambda a: children[a].W / children[a].N
+                       + c * math.sqrt(logN / children[a].N))
+        # PUCT
+        sqrtN = math.sqrt(node.N)
+        best = None
+        bestscore = None
+        for (a, bit), p in zip(node.moves, node.priors):
+            child = children.get(a)
+            if child is None or child.N == 0:
+                score = c * p * sqrtN
+            else:
+                score = child.W / child.N + c * p * sqrtN / (1 + child.N)
+            if best is None or score > bestscore:
+                best = a
+                bestscore = score
+        return best
+
+    def _expand(self, node, action):
+        bit = dict(node.moves)[action]
+        mine = node.me | bit
+        nstones = node.nstones + 1
+        if self._rules.wins(mine, bit):
+            terminal = -1  # the player to move in the child has lost
+        elif nstones == self._rules.ncells:
+            terminal = 0
+        else:
+            terminal = None
+        child = _Node(node.other, mine, node.code + self._rules.deltas[node.nstones & 1][bit],
+                      nstones, terminal)
+        node.children[action] = child
+        return child
+
+    def _rollout(self, node):
+        # :return: Result of a random game from node for the player to move in node
+        rules = self._rules
+        movebit = rules.movebit
+        wins = rules.wins
+        order = rules.order
+        choice = self._random.choice
+        me, other, code, nstones = node.me, node.other, node.code, node.nstones
+        sign = 1
+        while nstones < rules.ncells:
+            occupied = me | other
+            moves = []
+            for a in order:
+                bit = movebit(a, occupied)
+                if bit:
+                    if wins(me | bit, bit):
+                        return sign
+                    moves.append((a, bit))
+            if self._qlrollouts:
+                legal = 0
+                for idx, a in enumerate(rules.possibleActions):
+                    if movebit(a, occupied):
+                        legal |= 1 << idx
+                action = self._ql.selectAction(code, self._curiosity, legal)
+                bit = movebit(action, occupied)
+            else:
+                action, bit = choice(moves)
+            code += rules.deltas[nstones & 1][bit]
+            me, other = other, me | bit
+            nstones += 1
+            sign = -sign
+        return 0
+
+
+class MCTSAI(DumbAI):
+    '''
+    Player that selects its moves with MCTS within a time budget per move, so it also plays
+    decently without a trained Q-table and answers human players in a guaranteed time.
+
+    With ponder=True, the player keeps searching on a background thread while the opponent
+    thinks, in the tree below its own last move, i.e. on the opponent's likely replies and its
+    answers to them. The search stops when the opponent's move arrives, and the subtree of that
+    move is reused. Together with "visits", the answer then often comes without any further
+    search.
+    '''
+
+    def __init__(self, somename, game, budget=100, experienceFile=None, ponder=False,
+                 visits=None, ponderLimit=200000, **kwargs):
+        '''
+        :param game: The game that is played; the player keeps its own copy of the rules
+        :param budget: Time budget in milliseconds per move
+        :param ponder: Search on a background thread during the opponent's turn
+        :param visits: Answer as soon as the root has this many visits, see MCTS.search()
+        :param ponderLimit: Stop pondering when the root has this many visits, to bound memory
+        :param kwargs: Passed on to MCTS, e.g. a Qlearner as ql
+        '''
+        DumbAI.__init__(self, somename, experienceFile, game.POSSIBLE_ACTIONS)
+        self._mcts = MCTS(game, **kwargs)
+        self._budget = budget
+        self._ponder = ponder
+        self._visits = visits
+        self._ponderLimit = ponderLimit
+        self._ponderer = None
+        self._stopPonder = None
+        self.ponderIterations = 0
+
+    @property
+    def mcts(self):
+        return self._mcts
+
+    def setState(self, state, legal=None):
+        # a new state other than the one after our own move: the opponent has moved
+        root = self._mcts.root
+        if self._ponderer is not None and (root is None or root.code != state):
+            self._stopPondering()
+        super(MCTSAI, self).setState(state, legal)
+
+    def chooseAction(self, legal=None):
+        self._stopPondering()
+        action = self._mcts.search(self._actionstate, self._budget, self._visits)
+        self._mcts.choose(action)
+        if self._ponder:
+            self._startPondering()
+        return action
+
+    def _startPondering(self):
+        root = self._mcts.root
+        if root is None or root.terminal is not None:
+            return
+        self._stopPonder = threading.Event()
+        self._ponderer = threading.Thread(target=self._pondering, args=(root, self._stopPonder),
+                                          daemon=True)
+        self._ponderer.start()
+
+    def _pondering(self, root, stop):
+        # runs on the background thread; the main thread does not touch the tree meanwhile
+        while not stop.is_set() and root.N < self._ponderLimit:
+            self._mcts.iterate()
+            self.ponderIterations += 1
+
+    def _stopPondering(self):
+        if self._ponderer is not None:
+            self._stopPonder.set()
+            self._ponderer.join()
+            self._ponderer = None
+
+    def finalize(self):
+        self._stopPondering()
+        super(MCTSAI, self).finalize()
+        self._mcts.reset()
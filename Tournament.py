@@ -0,0 +1,221 @@
+'''
+Round-robin tournament between saved Q-tables: every pair of models plays a match in each seat
+order, with the greedy policies of the Q-tables (see Evaluation.GreedyAI), on a process pool.
+
+    python Tournament.py models/*.pkl [--game VierGewinnt] [--games 100] [--workers 4]
+        [--results models/tournament.jsonl]
+
+Every finished match is appended to the results file as a JSON line. Matches that are already in
+the file are not played again, so an interrupted tournament continues where it left off, and
+models can be added to a finished one. The table ranks the models by Elo ratings that are fitted
+to all results at once.
+'''
+import os
+import json
+import random
+import argparse
+import multiprocessing
+import numpy as np
+
+from Games import TicTacToe, VierGewinnt
+from Evaluation import STORES, GreedyAI, loadQlearner
+
+
+def pairings(Qfiles):
+    '''
+    :return: List of (first, second), every pair of models in both seat orders
+    '''
+    return [(first, second) for first in Qfiles for second in Qfiles if first != second]
+
+
+def loadResults(resultsFile):
+    '''
+    :return: Dict (first, second) -> result dict of the match, as written by tournament()
+    '''
+    results = {}
+    if resultsFile is not None and os.path.exists(resultsFile):
+        with open(resultsFile) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # a line that was cut off by a crash; the match is played again
+                    continue
+                results[(result['first'], result['second'])] = result
+    return results
+
+
+# per worker process: the board and every model the worker has played with, see _model()
+_worker = {}
+
+
+def _initWorker(board, store, symmetry):
+    _worker['board'] = board
+    _worker['store'] = store
+    _worker['symmetry'] = symmetry
+    _worker['models'] = {}
+
+
+def _model(Qfile):
+    # each model is loaded at most once per worker
+    models = _worker['models']
+    if Qfile not in models:
+        models[Qfile] = loadQlearner(_worker['board'], Qfile, _worker['store'],
+                                     _worker['symmetry'])
+    return models[Qfile]
+
+
+def _playMatch(task):
+    '''
+    Worker: play a match of n games with fixed seats.
+    :param task: Tuple (first, second, n, curiosity, seed)
+    :return: Result dict with the wins of the first and second model and the draws
+    '''
+    first, second, n, curiosity, seed = task
+    random.seed(seed)
+    np.random.seed(seed)
+    board = _worker['board']
+    players = []
+    for seat, Qfile in enumerate((first, second)):
+        ql = _model(Qfile)
+        ql.seed(seed + seat)
+        players.append(GreedyAI(os.path.basename(Qfile), ql, curiosity))
+    board.setplayers(players)
+    counts = [0, 0, 0]
+    for i in range(0, n):
+        board.reset()
+        board.play()
+        counts[board._status] += 1
+    return {'first': first, 'second': second, 'games': n, 'wins first': counts[0],
+            'wins second': counts[1], 'draws': counts[board.DRAW]}
+
+
+def tournament(board, Qfiles, N=100, resultsFile=None, nworkers=None, curiosity=None, seed=0,
+               store='RowQStore', symmetry=True):
+    '''
+    Play all matches that are not in resultsFile yet.
+    :param board: Game instance, e.g. VierGewinnt()
+    :param Qfiles: Q-tables, as saved by Qlearner.saveQ()
+    :param N: Games per match, i.e. per pair of models and seat order
+    :param resultsFile: JSON lines file with the results of the finished matches, see
+        loadResults(). None to keep the results in memory only.
+    :param nworkers: Number of worker processes, defaults to the number of CPUs
+    :param curiosity: See Evaluation.GreedyAI, None for the greedy policies
+    :param seed: Every match is seeded deterministically from (seed, first, second)
+    :param store, symmetry: How the Q-tables were learned, see Evaluation.loadQlearner()
+    :return: Dict (first, second) -> result dict of all matches between the Qfiles
+    '''
+    Qfiles = sorted(set(Qfiles))
+    results = loadResults(resultsFile)
+    tasks = []
+    for first, second in pairings(Qfiles):
+        if (first, second) not in results:
+            matchseed = int(np.random.SeedSequence(
+                [seed, Qfiles.index(first), Qfiles.index(second)]).generate_state(1)[0])
+            tasks.append((first, second, N, curiosity, matchseed))
+
+    if tasks:
+        with multiprocessing.Pool(nworkers, initializer=_initWorker,
+                                  initargs=(board, store, symmetry)) as pool:
+            for result in pool.imap_unordered(_playMatch, tasks):
+                results[(result['first'], result['second'])] = result
+                if resultsFile is not None:
+                    with open(resultsFile, 'a') as f:
+                        f.write(json.dumps(result) + '\n')
+                        f.flush()
+                        os.fsync(f.fileno())
+                print('{} vs {}: {:d}/{:d}/{:d}'.format(
+                    result['first'], result['second'], result['wins first'], result['draws'],
+                    result['wins second']))
+    return {pair: results[pair] for pair in pairings(Qfiles) if pair in results}
+
+
+def eloRatings(results, iterations=1000, tol=1e-9):
+    '''
+    Elo ratings that fit all results at once (Bradley-Terry model, fitted by minorization-
+    maximization), so they don't depend on the order in which the matches were played.
+    A draw counts half a win for both models. Every pair of models gets one virtual draw, so that
+    models without any win or loss still have finite ratings.
+    :param results: Dict (first, second) -> result dict, as returned by tournament()
+    :return: Table, a list of dicts with the keys 'model', 'elo', 'score', 'wins', 'draws', 'losses'
+        and 'games' for every model, sorted by Elo, best first. The mean Elo is 1500.
+    '''
+    models = sorted(set(m for pair in results for m in pair))
+    idx = {m: i for i, m in enumerate(models)}
+    K = len(models)
+    games = np.zeros((K, K))  # games between i and j, in any seat order
+    score = np.zeros((K, K))  # points of i against j
+    wdl = np.zeros((K, 3), dtype=np.int64)
+    for (first, second), r in results.items():
+        i, j = idx[first], idx[second]
+        games[i, j] += r['games']
+        games[j, i] += r['games']
+        score[i, j] += r['wins first'] + 0.5 * r['draws']
+        score[j, i] += r['wins second'] + 0.5 * r['draws']
+        wdl[i] += (r['wins first'], r['draws'], r['wins second'])
+        wdl[j] += (r['wins second'], r['draws'], r['wins first'])
+
+    # the virtual draws
+    played = games > 0
+    games = games + played
+    score = score + 0.5 * played
+    W = score.sum(axis=1)
+    gamma = np.ones(K)
+    for it in range(iterations):
+        newgamma = W / (games / (gamma[:, None] + gamma[None, :])).sum(axis=1)
+        newgamma /= np.exp(np.log(newgamma).mean())
+        converged = np.abs(newgamma - gamma).max() < tol
+        gamma = newgamma
+        if converged:
+            break
+    elo = 1500 + 400 * np.log10(gamma)
+
+    table = []
+    for i, m in enumerate(models):
+        n = int(wdl[i].sum())
+        table.append({'model': m, 'elo': float(elo[i]),
+                      'score': (wdl[i, 0] + 0.5 * wdl[i, 1]) / n if n else 0.0,
+                      'wins': int(wdl[i, 0]), 'draws': int(wdl[i, 1]), 'losses': int(wdl[i, 2]),
+                      'games': n})
+    table.sort(key=lambda row: -row['elo'])
+    return table
+
+
+def report(table):
+    width = max([len('model')] + [len(row['model']) for row in table])
+    lines = ['rank  {:{w}s}  {:>6s}  {:>6s}  {:>7s}  {:>7s}  {:>7s}'.format(
+        'model', 'Elo', 'score', 'wins', 'draws', 'losses', w=width)]
+    for rank, row in enumerate(table, 1):
+        lines.append('{:4d}  {:{w}s}  {:6.0f}  {:6.3f}  {:7d}  {:7d}  {:7d}'.format(
+            rank, row['model'], row['elo'], row['score'], row['wins'], row['draws'],
+            row['losses'], w=width))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Round-robin tournament between Q-tables.')
+    parser.add_argument('Qfiles', nargs='+')
+    parser.add_argument('--game', choices=['TicTacToe', 'VierGewinnt'], default='VierGewinnt')
+    parser.add_argument('--nrows', type=int, default=VierGewinnt.NROWS)
+    parser.add_argument('--ncols', type=int, default=VierGewinnt.NCOLS)
+    parser.add_argument('--connect', type=int, default=VierGewinnt.CONNECT)
+    parser.add_argument('--games', type=int, default=100, help='games per match')
+    parser.add_argument('--results', default='models/tournament.jsonl',
+                        help='results file, the tournament continues from it')
+    parser.add_argument('--curiosity', type=float, default=None,
+                        help='play near-greedy Boltzmann policies instead of greedy ones')
+    parser.add_argument('--store', choices=STORES, default='RowQStore',
+                        help='storage format of the Q-tables')
+    parser.add_argument('--nosymmetry', action='store_true',
+                        help='the Q-tables were learned without symmetry')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.game == 'TicTacToe':
+        board = TicTacToe()
+    else:
+        board = VierGewinnt(args.nrows, args.ncols, args.connect)
+    results = tournament(board, args.Qfiles, args.games, args.results, args.workers,
+                         args.curiosity, args.seed, args.store, not args.nosymmetry)
+    print(report(eloRatings(results)))
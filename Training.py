@@ -0,0 +1,94 @@
+import random
+import time
+import multiprocessing
+import numpy as np
+
+from Players import SmartAI
+
+
+class RecordingSmartAI(SmartAI):
+    '''
+    SmartAI that keeps a copy of each finished game's experiences in a list.
+    '''
+
+    def __init__(self, somename, ql, curiosity, games):
+        SmartAI.__init__(self, somename, None, ql, curiosity)
+        self._games = games
+
+    def finalize(self):
+        self._games.append(self._game)
+        super(RecordingSmartAI, self).finalize()
+
+
+def _seed(seed, roundNumber, workerNumber):
+    # independent, reproducible random streams for every worker and round
+    return int(np.random.SeedSequence([seed, roundNumber, workerNumber]).generate_state(1)[0])
+
+
+def _selfplay(task):
+    '''
+    Worker: play K games of SmartAI self-play on a local copy of the Q-table.
+    :param task: Tuple (board, ql, K, curiosity, seed)
+    :return: Tuple (list of games, i.e. experiences of both players, list of final game status)
+    '''
+    board, ql, K, curiosity, seed = task
+    random.seed(seed)
+    np.random.seed(seed)
+    ql.seed(seed)
+
+    games = []
+    board.setplayers([RecordingSmartAI('Smart AI 0', ql, curiosity, games),
+                      RecordingSmartAI('Smart AI 1', ql, curiosity, games)])
+    result = []
+    for i in range(0, K):
+        board.reset()
+        board.play()
+        result.append(board._status)
+    return games, result
+
+
+class ParallelTrainer:
+    '''
+    Self-play training on several processes.
+    Training runs in rounds: every worker process plays K games with its own copy of the master
+    Q-table (and also learns from them locally). After each round, the coordinator replays all
+    games of all workers into the master Qlearner via batchlearnQ() and sends the updated table
+    out for the next round.
+    '''
+
+    def __init__(self, board, ql, nworkers, K, curiosity=0.1, seed=0):
+        '''
+        :param board: Game instance, e.g. VierGewinnt(); every worker gets its own copy
+        :param ql: The master Qlearner
+        :param nworkers: Number of worker processes
+        :param K: Number of games per worker and round
+        :param seed: Base seed; worker w in round n is seeded deterministically from (seed, n, w)
+        '''
+        self._board = board
+        self._ql = ql
+        self._nworkers = nworkers
+        self._K = K
+        self._curiosity = curiosity
+        self._seed = seed
+        self._round = 0
+
+    def train(self, M, callback=None):
+        '''
+        Play (at least) M games, rounded up to full rounds.
+        :param callback: Optional function callback(gamesplayed, gamespersecond), called after
+            each round
+        :return: List with the final status of all games
+        '''
+        result = []
+        t0 = time.perf_counter()
+        with multiprocessing.Pool(self._nworkers) as pool:
+            while len(result) < M:
+                tasks = [(self._board, self._ql, self._K, self._curiosity,
+                          _seed(self._seed, self._round, w)) for w in range(self._nworkers)]
+                for games, status in pool.map(_selfplay, tasks):
+                    self._ql.batchlearnQ(games, 1, backprop=True)
+                    result.extend(status)
+                self._round += 1
+                if callback is not None:
+                    callback(len(result), len(result) / (time.perf_counter() - t0))
+        return result
@@ -1,3 +1,5 @@
+from Games import TicTacToe, VierGewinnt
+
 # TODO: Remove the stupid hard-coded numbers: What is "5", what is "9"...
 # TODO: In a way, the Visualizer needs to know the size of the board -> couple with Games.py?
 
@@ -53,7 +55,8 @@ class TicTacToeVisualizer:
         return chr(ascii_code)
 
     def visualizeState(self, state):
-        self._boardstate = state
+        # the game sends state codes
+        self._boardstate = TicTacToe.decodeState(state)
         lines = []
         line = ''
         for idx in range(6, 9):
@@ -82,13 +85,13 @@ class TicTacToeVisualizer:
         self._screen.clear()
 
 
-# TODO: In a way, the Visualizer needs to know the size of the board -> couple with Games.py?
 class VierGewinntVisualizer:
-    NCOLS = 5
-    NROWS = 5
 
-    def __init__(self, Nb, Np):
+    def __init__(self, Nb, Np, nrows=VierGewinnt.NROWS, ncols=VierGewinnt.NCOLS):
         # TODO: revisit the Nb and Np parameters: really needed?
+        # nrows, ncols: board size, as passed to VierGewinnt()
+        self.NROWS = nrows
+        self.NCOLS = ncols
         self._screen = None  # a "curses" screen as created by wrapper() in curses module
         self._Nb = Nb       # number of lines reserved for board
         self._Np = Np       # number of lines reserved for messages to players
@@ -138,7 +141,8 @@ class VierGewinntVisualizer:
         return chr(ascii_code)
 
     def visualizeState(self, state):
-        self._boardstate = state
+        # the game sends state codes
+        self._boardstate = VierGewinnt.decodeState(state, self.NROWS, self.NCOLS)
         lines = []
         # plot from top to bottom: higher idxrow comes first
         for idxrow in range(self.NROWS - 1, -1, -1):
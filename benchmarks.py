@@ -0,0 +1,254 @@
+'''
+Benchmark suite for the game engines, players and learners.
+
+    python benchmarks.py [--scale 0.1] [--only games qlearner] [--output results.json]
+
+Every benchmark returns a dict of metrics. All results are printed and, with --output, written
+as one JSON document together with some information about the environment, so that results of
+different releases can be compared.
+'''
+import time
+import random
+import os
+import sys
+import json
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+from Games import TicTacToe, VierGewinnt
+from Learners import Qlearner, PairQStore, RowQStore, DenseQStore
+from Players import DumbAI, SmartAI
+from Training import ParallelTrainer, RecordingSmartAI
+from Evaluation import GreedyAI
+
+
+def _makestore(name, board):
+    actions = board.POSSIBLE_ACTIONS
+    if name == 'PairQStore':
+        return PairQStore(actions, board.R_DEFAULT)
+    elif name == 'RowQStore':
+        return RowQStore(actions, board.R_DEFAULT)
+    elif name == 'DenseQStore':
+        return DenseQStore(TicTacToe.enumerateStates(), actions, board.R_DEFAULT)
+    raise ValueError(name)
+
+
+def _playgames(board, players, M):
+    # :return: games per second
+    board.setplayers(players)
+    t0 = time.perf_counter()
+    for i in range(0, M):
+        board.reset()
+        board.play()
+    return M / (time.perf_counter() - t0)
+
+
+def _train(board, storename, M):
+    '''
+    SmartAI self-play with a fresh Qlearner.
+    :return: Tuple (Qlearner, games per second, list of games)
+    '''
+    random.seed(0)
+    np.random.seed(0)
+    ql = Qlearner(None, board.POSSIBLE_ACTIONS, board.R_DEFAULT, alpha=0.1, lam=0.8,
+                  store=_makestore(storename, board))
+    games = []
+    gps = _playgames(board, [RecordingSmartAI('Smart AI 0', ql, 0.1, games),
+                             RecordingSmartAI('Smart AI 1', ql, 0.1, games)], M)
+    return ql, gps, games
+
+
+def bench_games(scale):
+    '''
+    games/sec of the game engines with random and with learning players.
+    '''
+    result = {}
+    M = max(1, int(20000 * scale))
+    for name, makeboard in (('TicTacToe', TicTacToe),
+                            ('VierGewinnt', VierGewinnt),
+                            ('VierGewinnt bitboard', lambda: VierGewinnt(bitboard=True))):
+        random.seed(0)
+        board = makeboard()
+        result[name + ', DumbAI vs DumbAI, games/sec'] = \
+            _playgames(board, [DumbAI('Dumbo 0', None, board.POSSIBLE_ACTIONS),
+                               DumbAI('Dumbo 1', None, board.POSSIBLE_ACTIONS)], M)
+        result[name + ', SmartAI vs SmartAI, games/sec'] = _train(makeboard(), 'RowQStore', M)[1]
+    return result
+
+
+def bench_qlearner(scale):
+    '''
+    ops/sec of updateQ(), selectAction() and batchlearnQ() on a VierGewinnt Q-table that was
+    learned in self-play, for each Q-store.
+    '''
+    result = {}
+    M = max(1, int(5000 * scale))
+    for storename in ('PairQStore', 'RowQStore'):
+        ql, gps, games = _train(VierGewinnt(), storename, M)
+        experiences = [experience for game in games for experience in game]
+        states = [experience[0] for experience in experiences]
+
+        t0 = time.perf_counter()
+        for S, a, r, nextS in experiences:
+            ql.updateQ(S, a, r, nextS)
+        result[storename + ', updateQ/sec'] = len(experiences) / (time.perf_counter() - t0)
+
+        for curiosity in (None, 0.1):
+            t0 = time.perf_counter()
+            for S in states:
+                ql.selectAction(S, curiosity)
+            result[storename + ', selectAction(curiosity={})/sec'.format(curiosity)] = \
+                len(states) / (time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        ql.batchlearnQ(games, 1, backprop=True)
+        result[storename + ', batchlearnQ experiences/sec'] = \
+            len(experiences) / (time.perf_counter() - t0)
+    return result
+
+
+def bench_storage(scale):
+    '''
+    saveQ()/load time and size on disk for each Q-store.
+    Bytes per state counts the states that are stored, i.e. that have at least one learned Q
+    (PairQStore, RowQStore) or a row in the matrix (DenseQStore: all states).
+    '''
+    result = {}
+    M = max(1, int(10000 * scale))
+    tmpdir = tempfile.mkdtemp()
+    for gamename, makeboard, storenames in (
+            ('TicTacToe', TicTacToe, ('PairQStore', 'RowQStore', 'DenseQStore')),
+            ('VierGewinnt', VierGewinnt, ('PairQStore', 'RowQStore'))):
+        for storename in storenames:
+            board = makeboard()
+            ql = _train(board, storename, M)[0]
+            Qfile = os.path.join(tmpdir, gamename + storename)
+            ql._Qfile = Qfile
+
+            t0 = time.perf_counter()
+            ql.saveQ()
+            tsave = time.perf_counter() - t0
+            store = _makestore(storename, board)
+            t0 = time.perf_counter()
+            store.load(Qfile)
+            tload = time.perf_counter() - t0
+
+            states = len(ql._store.states())
+            prefix = '{}, {}, '.format(gamename, storename)
+            result[prefix + 'states'] = states
+            result[prefix + 'saveQ sec'] = tsave
+            result[prefix + 'load sec'] = tload
+            result[prefix + 'bytes/state'] = os.path.getsize(Qfile) / states
+    return result
+
+
+def bench_parallel(scale):
+    '''
+    games/sec of VierGewinnt self-play training with ParallelTrainer, including merging and
+    broadcasting the Q-table, for an increasing number of workers.
+    '''
+    result = {}
+    M = max(1, int(20000 * scale))
+    for nworkers in sorted(set([1, 2, 4, os.cpu_count()])):
+        board = VierGewinnt(bitboard=True)
+        ql = Qlearner(None, board.POSSIBLE_ACTIONS, board.R_DEFAULT, alpha=0.1, lam=0.8,
+                      store=RowQStore(board.POSSIBLE_ACTIONS, board.R_DEFAULT))
+        trainer = ParallelTrainer(board, ql, nworkers, max(1, M // (4 * nworkers)), seed=0)
+        t0 = time.perf_counter()
+        played = len(trainer.train(M))
+        result['{:d} workers, games/sec'.format(nworkers)] = played / (time.perf_counter() - t0)
+    return result
+
+
+def bench_returns(scale):
+    '''
+    Games and training time until a SmartAI that learns against DumbAI on VierGewinnt reaches a
+    target win rate with its greedy policy, for one-step Q-learning, n-step returns and Q(lambda),
+    learned from whole games in batchlearnQ() and online with eligibility traces.
+    None if the target is not reached.
+    '''
+    result = {}
+    target = 0.85
+    M = max(1, int(20000 * scale))
+    every = max(1, M // 10)
+    neval = 300
+    for name, kwargs, online in (('one-step', {}, False),
+                                 ('3-step', {'nsteps': 3}, False),
+                                 ('Q(lambda=0.8)', {'tracedecay': 0.8}, False),
+                                 ('online one-step', {}, True),
+                                 ('online Q(lambda=0.8)', {'tracedecay': 0.8}, True)):
+        random.seed(0)
+        np.random.seed(0)
+        board = VierGewinnt()
+        actions = board.POSSIBLE_ACTIONS
+        ql = Qlearner(None, actions, board.R_DEFAULT, alpha=0.1, lam=0.8,
+                      store=RowQStore(actions, board.R_DEFAULT), symmetry=board, seed=0, **kwargs)
+        players = [SmartAI('Smart AI', None, ql, curiosity=0.1, online=online),
+                   DumbAI('Dumbo', None, actions)]
+        evalboard = VierGewinnt()
+        evalboard.setplayers([GreedyAI('Greedy AI', ql), DumbAI('Dumbo', None, actions)])
+
+        games, sec = None, None
+        played, training = 0, 0.0
+        while played < M and games is None:
+            training += every / _playgames(board, players, every)
+            played += every
+            wins = 0
+            for i in range(0, neval):
+                evalboard.reset()
+                evalboard.play()
+                wins += evalboard._status == 0
+            if wins >= target * neval:
+                games, sec = played, training
+        result[name + ', games to {:.0%} wins'.format(target)] = games
+        result[name + ', training sec to {:.0%} wins'.format(target)] = sec
+    return result
+
+
+BENCHMARKS = {'games': bench_games,
+              'qlearner': bench_qlearner,
+              'storage': bench_storage,
+              'parallel': bench_parallel,
+              'returns': bench_returns}
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        commit = commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit,
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+def run(names, scale):
+    results = {}
+    for name in names:
+        print(name)
+        results[name] = BENCHMARKS[name](scale)
+        for key, value in results[name].items():
+            print('  {:60s} {:>14}'.format(key, 'n/a' if value is None else '{:.6g}'.format(value)))
+    return {'environment': environment(), 'scale': scale, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark game engines, players and learners.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='scales the number of games of all benchmarks')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    report = run(args.only, args.scale)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
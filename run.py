@@ -1,16 +1,26 @@
+import os
 import time
 import numpy as np
 import pickle
-from curses import wrapper
-import matplotlib.pyplot as plt
 
 from Games import TicTacToe, VierGewinnt
-from Learners import Qlearner
+from Learners import Qlearner, RowQStore, BoundedQStore, MappedQStore, compileQfile
+from Training import ParallelTrainer
+from Experience import ExperienceLog
+from Instrumentation import GameInstrumentation
+from Metrics import MetricsSink, boxedRates, plotMetrics
 from Players import DumbAI, SmartAI, HumanPlayerInterface
+from Search import MCTSAI
 from Visualizers import TicTacToeVisualizer, VierGewinntVisualizer
 
 
 def loadGames(gamesFile):
+    # Games are streamed from the memory-mapped file, not loaded into RAM
+    return ExperienceLog(gamesFile)
+
+
+def loadPickledGames(gamesFile):
+    # legacy format: one pickle per game
     games = []
     with open(gamesFile, 'rb') as f:
         eof = False
@@ -31,6 +41,8 @@ def printGames(games):
 
 
 def plot_exp_mav(result):
+    import matplotlib.pyplot as plt
+
     M = len(result)
     win0, win0rate = 0.34, []
     win1, win1rate = 0.29, []
@@ -62,51 +74,131 @@ def plot_exp_mav(result):
 
 
 def plot_boxed_av(result):
-    win0rate = []
-    win1rate = []
-    drawrate = []
+    # imported here, so that the rest of this module also works on hosts without matplotlib
+    import matplotlib.pyplot as plt
 
-    M = len(result)
-    i = 0
-    K = 1000
-    while i+K <= M:
-        sub = result[i:i+K]
-        win0rate.append(sum([1 if s == 0 else 0 for s in sub])/K)
-        win1rate.append(sum([1 if s == 1 else 0 for s in sub])/K)
-        drawrate.append(sum([1 if s == 2 else 0 for s in sub])/K)
-        i += K
-
-    plt.plot(range(0, len(win0rate)), win0rate)
-    plt.plot(range(0, len(win1rate)), win1rate)
-    plt.plot(range(0, len(drawrate)), drawrate)
+    rates = boxedRates(result, K=1000)
+    plt.plot(range(0, len(rates)), rates[:, 0])
+    plt.plot(range(0, len(rates)), rates[:, 1])
+    plt.plot(range(0, len(rates)), rates[:, 2])
     plt.legend(['win 0', 'win 1', 'draw'])
     plt.show()
 
 
-def practice(M, board, Qfile0, Qfile1):
+def practice(M, board, Qfile0, Qfile1, checkpointEvery=None, compactEvery=10, capacity=None,
+             instrument=False, instrumentFile=None, metricsFile=None):
     # online practicing
+    # Every checkpointEvery games, Q changes are appended to a checkpoint log; every compactEvery
+    # checkpoints, the log is merged into Qfile0 in the background (see Qlearner.checkpoint()).
+    # After a crash, simply start again: Qlearner restores Q from Qfile0 plus the log.
+    # With a capacity, at most that many states are kept in memory (see BoundedQStore).
+    # With instrument, per-phase timings of the game loop are printed every 1000 games and
+    # appended to instrumentFile as JSON lines, if given (see Instrumentation.py).
+    # Win/draw rates, games/sec, moves/game and the Q size are printed every 1000 games and
+    # written to metricsFile (CSV or JSON lines), which is plotted at the end (see Metrics.py).
     #random.seed(time.time())
     np.random.seed(0)
 
     possibleActions = board.POSSIBLE_ACTIONS
     defaultReward = board.R_DEFAULT
 
-    ql0 = Qlearner(Qfile0, possibleActions, defaultReward, alpha=0.1, lam=0.8)
+    if capacity is None:
+        store = RowQStore(possibleActions, defaultReward, encodeState=board.encodeState,
+                          symmetry=board)
+    else:
+        store = BoundedQStore(capacity, possibleActions, defaultReward,
+                              encodeState=board.encodeState, symmetry=board)
+    ql0 = Qlearner(Qfile0, possibleActions, defaultReward, alpha=0.1, lam=0.8,
+                   store=store, symmetry=board, checkpoints=checkpointEvery is not None)
     sL0 = SmartAI('Smart AI 0', None, ql0, curiosity=0.1)
     sL1 = SmartAI('Smart AI 1', None, ql0, curiosity=0.1)  # Using the same Q-learner for both AIs
-    dP = DumbAI('Dumbo', None)
+    dP = DumbAI('Dumbo', None, possibleActions)
 
     pls = [sL0, sL1]
     board.setplayers(pls)
 
-    result = []
+    inst = None
+    if instrument:
+        inst = GameInstrumentation()
+        board.instrumentation = inst
+        ql0.instrumentation = inst
+
+    metrics = MetricsSink(metricsFile, every=1000, ql=ql0)
     for i in range(0, M):
         if i % 1000 == 0:
-            print('{:d} to go, {:d} states/action-pairs visited '.format(M - i,len(ql0._knownQs)))
+            if hasattr(ql0._store, 'stats'):
+                print(ql0._store.stats())
+            if inst is not None and inst.games > 0:
+                print(inst.report())
+                if instrumentFile is not None:
+                    with open(instrumentFile, 'a') as f:
+                        inst.dump(f)
+                inst.reset()
 
         board.reset()
         board.play()
-        result.append(board._status)
+        metrics.add(board._status, board.nmoves())
+
+        if checkpointEvery is not None and (i + 1) % checkpointEvery == 0:
+            if (i + 1) % (checkpointEvery * compactEvery) == 0:
+                ql0.compact()
+            else:
+                ql0.checkpoint()
+
+    ql0.saveQ()
+    metrics.close()
+
+    if metricsFile is not None:
+        plotMetrics(metricsFile)
+
+
+def parallel_practice(M, board, Qfile0, nworkers, K=1000):
+    # online practicing on several processes, see Training.py
+    np.random.seed(0)
+
+    possibleActions = board.POSSIBLE_ACTIONS
+    defaultReward = board.R_DEFAULT
+
+    ql0 = Qlearner(Qfile0, possibleActions, defaultReward, alpha=0.1, lam=0.8,
+                   store=RowQStore(possibleActions, defaultReward, encodeState=board.encodeState,
+                                   symmetry=board), symmetry=board)
+    trainer = ParallelTrainer(board, ql0, nworkers, K, curiosity=0.1, seed=0)
+
+    def progress(gamesplayed, gamespersecond):
+        print('{:d} to go, {:d} Q entries stored, {:.0f} games/sec '.format(
+            M - gamesplayed, len(ql0), gamespersecond))
+
+    result = trainer.train(M, progress)
+
+    ql0.saveQ()
+
+    plot_boxed_av(result)
+
+
+def batch_practice(M, batchboard, Qfile0):
+    # online practicing on many boards in lockstep; batchboard is e.g. a
+    # BatchGames.VierGewinntBatch(N)
+    np.random.seed(0)
+
+    possibleActions = batchboard.POSSIBLE_ACTIONS
+    defaultReward = batchboard.R_DEFAULT
+
+    ql0 = Qlearner(Qfile0, possibleActions, defaultReward, alpha=0.1, lam=0.8,
+                   store=RowQStore(possibleActions, defaultReward,
+                                   encodeState=batchboard.game.encodeState,
+                                   symmetry=batchboard.game), symmetry=batchboard.game)
+
+    batchboard.reset()
+    result = []
+    while len(result) < M:
+        actions = ql0.selectActions(batchboard.states(), curiosity=0.1, legal=batchboard.legal())
+        experiences, status = batchboard.step(actions)
+        ql0.updateQs(*experiences)
+
+        finished = status[status != batchboard.game.READY]
+        if len(result) // 1000 != (len(result) + len(finished)) // 1000:
+            print('{:d} to go, {:d} Q entries stored '.format(M - len(result), len(ql0)))
+        result.extend(finished.tolist())
 
     ql0.saveQ()
 
@@ -139,23 +231,40 @@ if __name__ == '__main__':
 
     if train:
         board = VierGewinnt()
-        practice(1000000, board, Qfile, None)
+        practice(1000000, board, Qfile, None, metricsFile='models/QVierGewinnt.metrics.csv')
 
     else:
         board = VierGewinnt()
-        visualizer = VierGewinntVisualizer(5, 2)
+        visualizer = VierGewinntVisualizer(board.NROWS, 2, board.NROWS, board.NCOLS)
 
         possibleActions = board.POSSIBLE_ACTIONS
         default_reward = board.R_DEFAULT
-        ql0 = Qlearner(Qfile, possibleActions, default_reward, alpha=0.1, lam=0.5)
-        sP0 = SmartAI('Smart AI 0', None, ql0, curiosity=0.0)
-        sP1 = SmartAI('Smart AI 1', None, ql0, curiosity=0.0)
+        # play from the compiled, memory-mapped Q-table: no loading time, but read-only.
+        # It is compiled again when Qfile or its checkpoint logs are newer.
+        Qmap = 'models/QVierGewinnt.qmap.npy'
+        sources = [f for f in (Qfile, Qfile + '.log', Qfile + '.log.compacting')
+                   if os.path.exists(f)]
+        if sources:
+            if not os.path.exists(Qmap) \
+                    or os.path.getmtime(Qmap) < max(os.path.getmtime(f) for f in sources):
+                compileQfile(Qfile, Qmap, possibleActions, default_reward,
+                             encodeState=board.encodeState, symmetry=board)
+            ql0 = Qlearner(Qmap, possibleActions, default_reward, alpha=0.1, lam=0.5,
+                           store=MappedQStore(possibleActions, default_reward), symmetry=board)
+        else:
+            # nothing trained yet
+            ql0 = Qlearner(None, possibleActions, default_reward, alpha=0.1, lam=0.5,
+                           store=RowQStore(possibleActions, default_reward), symmetry=board)
+        # MCTS with the learned Qs as prior, even with a poor Q-table. It ponders while the human
+        # thinks and answers at once if the reply was searched 10000 times, else within 2 s.
+        mP0 = MCTSAI('MCTS AI 0', board, budget=2000, visits=10000, ponder=True, ql=ql0)
 
         hP0 = HumanPlayerInterface('Lotte', visualizer)
         hP1 = HumanPlayerInterface('Jo', visualizer)
-        pls = [sP0, hP1]
+        pls = [mP0, hP1]
         board.setplayers(pls)
 
+        from curses import wrapper
         wrapper(curses_game, board, visualizer)
 
     # TODO: do something with this legacy timing code.